@@ -26,9 +26,20 @@ import subprocess
 import signal
 import cv2
 import glob
+import re
 from datetime import timedelta
 import numpy as np
 import math
+from functools import lru_cache
+import fcntl
+import struct
+import ctypes, ctypes.util
+import threading
+import queue
+import asyncio
+import shutil
+import getpass
+from collections import deque
 from gpiozero import Button
 
 version  = 4.64
@@ -47,6 +58,50 @@ FDN            = 16  # Pi v3 camera Focus DN GPIO button
 # set sq_dis = 1 for a square display, 0 for normal
 sq_dis = 0
 
+# preview transport, 0 = jpg files in /run/shm, 1 = mjpeg stream from libcamera-vid via a pipe,
+# 2 = raw yuv420 stream at display size via a pipe (no jpg encode/decode)
+prev_pipe = 1
+prev_ring = 4        # number of piped preview frames buffered
+prev_threads = 2     # preview decoding threads
+prev_wait = 0.3      # seconds after the last mouse release before changed settings restart the preview
+
+# stills are taken with libcamera-still kept running in signal mode while the settings don't change
+still_hold   = 2     # seconds libcamera-still is kept running after a still before the preview restarts
+still_settle = 4     # seconds for AE/AWB to settle after libcamera-still starts
+
+# pre-record, with prerec > 0 and the h264 codec CAPTURE Video arms the camera and keeps the last prerec seconds
+# of video in memory, click CAPTURE again to save them followed by vlen seconds of live video
+prerec = 0
+
+# vid_tee = 1 shows the video in the GUI preview while recording, for mjpeg, or h264 if ffmpeg is installed
+vid_tee = 0
+
+# stream_fan = 1 serves STREAM to many viewers at once from one libcamera-vid (raw h264 over tcp or http on
+# stream_port), 0 = libcamera-vid --listen, one viewer and the stream stops when they disconnect
+stream_fan   = 1
+stream_max   = 8       # most viewers at once
+stream_queue = 64      # chunks queued per viewer before a slow one is dropped
+
+# web_port > 0 serves the preview to browsers, http://pi_address:web_port/ , the preview jpgs are sent as they are
+web_port = 0
+web_fps  = 10          # most frames a second sent to each browser
+web_max  = 4           # most browsers at once
+
+# focus value shown in zoom and manual focus, 'laplacian', 'tenengrad', 'variance' or 'brenner'
+# (see FOCUS METRICS, compare them on your own frames with --focus-bench DIR)
+focus_metric = 'laplacian'
+
+# focus peaking, edges in the preview are shown in peak_color. Press p to switch it on / off
+peaking    = 0
+peak_level = 40      # laplacian level counted as an edge
+peak_color = (255,0,0)
+
+# zebra stripes over highlights at or above zebra_level, and exposure numbers on the preview, mean Y, R, G, B,
+# % at or above zebra_level and % at or below shadow_level. Press z to switch them on / off
+zebra        = 0
+zebra_level  = 250
+shadow_level = 5
+
 # set default values (see limits below)
 rotate      = 0      # rotate preview ONLY, 0 = none, 1 = 90, 2 = 180, 3 = 270
 camera      = 0       # choose camera to use
@@ -88,7 +143,11 @@ con_file    = "PiLCConfig12.txt"
 
 # setup directories
 Home_Files  = []
-Home_Files.append(os.getlogin())
+try:
+    Home_Files.append(os.getlogin())
+except OSError:
+    # no controlling terminal, e.g. started headless from cron or systemd
+    Home_Files.append(getpass.getuser())
 pic_dir     = "/home/" + Home_Files[0]+ "/" + pic + "/"
 vid_dir     = "/home/" + Home_Files[0]+ "/" + vid + "/"
 config_file = "/home/" + Home_Files[0]+ "/" + con_file
@@ -103,6 +162,81 @@ max_16mp    = 200
 max_64mp    = 435
 max_gs      = 15
 
+# FOCUS METRICS
+# focus values for a grey (or Y plane) crop, worked in float32 in buffers kept between frames.
+# 'laplacian' = variance of the laplacian, 'tenengrad' = mean sobel gradient energy,
+# 'variance' = grey level variance / mean, 'brenner' = mean squared difference of pixels 2 apart.
+# step > 1 takes every step'th pixel first for a quicker value from a large area.
+# python3 PiLibCameraGUI.py --focus-bench DIR times each metric on the jpgs in DIR, taken in name order
+# through a focus sweep, and shows how cleanly each one rises to a single peak.
+focus_metrics = ('laplacian','tenengrad','variance','brenner')
+focus_f32     = np.empty((0,0),np.float32)
+focus_gx      = np.empty((0,0),np.float32)
+focus_gy      = np.empty((0,0),np.float32)
+
+def focus_value(gray,metric,step=1):
+    global focus_f32,focus_gx,focus_gy
+    if step > 1:
+        gray = gray[::step,::step]
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0
+    if metric == 'variance':
+        mean,dev = cv2.meanStdDev(gray)
+        if mean[0][0] == 0:
+            return 0
+        return (dev[0][0] * dev[0][0])/mean[0][0]
+    if focus_f32.shape != gray.shape:
+        focus_f32 = np.empty(gray.shape,np.float32)
+        focus_gx  = np.empty(gray.shape,np.float32)
+        focus_gy  = np.empty(gray.shape,np.float32)
+    np.copyto(focus_f32,gray)
+    if metric == 'tenengrad':
+        cv2.Sobel(focus_f32,cv2.CV_32F,1,0,dst=focus_gx,ksize=3)
+        cv2.Sobel(focus_f32,cv2.CV_32F,0,1,dst=focus_gy,ksize=3)
+        cv2.multiply(focus_gx,focus_gx,dst=focus_gx)
+        cv2.multiply(focus_gy,focus_gy,dst=focus_gy)
+        cv2.add(focus_gx,focus_gy,dst=focus_gx)
+        return cv2.mean(focus_gx)[0]
+    if metric == 'brenner':
+        w = gray.shape[1] - 2
+        dif = focus_gx[:,:w]
+        cv2.subtract(focus_f32[:,2:],focus_f32[:,:w],dst=dif)
+        cv2.multiply(dif,dif,dst=dif)
+        return cv2.mean(dif)[0]
+    cv2.Laplacian(focus_f32,cv2.CV_32F,dst=focus_gx)
+    dev = cv2.meanStdDev(focus_gx)[1][0][0]
+    return dev * dev
+
+def focus_bench(bdir):
+    files = sorted(glob.glob(os.path.join(bdir,"*.jpg")))
+    if len(files) < 2:
+        print("focus bench needs a focus sweep of jpgs in " + bdir)
+        return
+    grays = []
+    for f in files:
+        gray = cv2.imread(f,cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            continue
+        h,w = gray.shape
+        grays.append(gray[int(h/2)-histarea:int(h/2)+histarea,int(w/2)-histarea:int(w/2)+histarea])
+    print(str(len(grays)) + " frames, " + str(histarea * 2) + "x" + str(histarea * 2) + " centre crop")
+    print("metric      step    ms/frame  peak  turns  peak/min")
+    for metric in focus_metrics:
+        for step in (1,2):
+            start = time.perf_counter()
+            vals = [focus_value(gray,metric,step) for gray in grays]
+            ms = (time.perf_counter() - start) * 1000/len(grays)
+            # a good metric rises to one peak and falls, 1 turn
+            dirs  = [1 if vals[n+1] > vals[n] else -1 for n in range(0,len(vals)-1) if vals[n+1] != vals[n]]
+            turns = len([n for n in range(0,len(dirs)-1) if dirs[n+1] != dirs[n]])
+            peak  = vals.index(max(vals))
+            ratio = max(vals)/max(min(vals),1e-9)
+            print("%-11s %4d %11.3f %5d %6d %9.1f" % (metric,step,ms,peak,turns,ratio))
+
+if len(sys.argv) > 2 and sys.argv[1] == "--focus-bench":
+    focus_bench(sys.argv[2])
+    sys.exit()
+
 # inital parameters
 foc_man     = 0
 prev_fps    = 10 
@@ -120,8 +254,8 @@ igw         = 2592
 igh         = 1944
 zwidth      = igw 
 zheight     = igh
-buttonFUP   = Button(FUP)
-buttonFDN   = Button(FDN)
+buttonFUP   = Button(FUP, hold_time=0.25, hold_repeat=True)
+buttonFDN   = Button(FDN, hold_time=0.25, hold_repeat=True)
 if tinterval > 0:
     tduration  = tshots * tinterval
 else:
@@ -217,21 +351,45 @@ v3_f_speed  = config[29]
 v3_f_range  = config[30]
 #rotate      = config[31]
 
+# CAMERA PROBE
+# libcamera-vid --list-cameras is read once at start, giving each camera's sensor, full resolution and
+# modes as (width,height,bits,fps,crop width,crop height)
+# e.g. 0 : imx708 [4608x2592 10-bit RGGB] (/base/soc/i2c0mux/i2c@1/imx708@1a)
+#          Modes: 'SRGGB10_CSI2P' : 1536x864 [120.13 fps - (768, 432)/3072x1728 crop]
+cams = {}
+
+def camera_probe():
+    global cams
+    cams = {}
+    try:
+        out = subprocess.run(["libcamera-vid","--list-cameras"],stdout=subprocess.PIPE,stderr=subprocess.STDOUT,timeout=10).stdout.decode(errors='ignore')
+    except (OSError,subprocess.TimeoutExpired):
+        return
+    cam  = None
+    bits = 0
+    for line in out.splitlines():
+        found = re.match(r"\s*(\d+) : (\S+) \[(\d+)x(\d+)[^\]]*\] \((.*)\)",line)
+        if found:
+            cam = {'sensor':found.group(2),'width':int(found.group(3)),'height':int(found.group(4)),'path':found.group(5),'modes':[]}
+            cams[int(found.group(1))] = cam
+            continue
+        if cam == None:
+            continue
+        found = re.search(r"'[A-Z]+(\d+)\w*' :",line)
+        if found:
+            bits = int(found.group(1))
+        for w,h,f,cw,ch in re.findall(r"(\d+)x(\d+) \[([\d.]+) fps - \(\d+, \d+\)/(\d+)x(\d+) crop\]",line):
+            cam['modes'].append((int(w),int(h),bits,float(f),int(cw),int(ch)))
+
 def Camera_Version():
   # Check for Pi Camera version
-  global mag,max_gain,max_shutter,Pi_Cam,igw,camera,FUP,FDN,GPIO,still_limits,buttonFUP,buttonFDN
-  if os.path.exists('test.jpg'):
-      os.rename('test.jpg', 'oldtest.jpg')
-  rpistr = "libcamera-jpeg --camera " + str(camera) + " -n -t 1000 -e jpg -o test.jpg "
-  os.system(rpistr)
-  rpistr = ""
-  time.sleep(2)
-  if os.path.exists('test.jpg'):
-    imagefile = 'test.jpg'
-    image = pygame.image.load(imagefile)
-    igw = image.get_width()
-    igh = image.get_height()
-    print(igw,"x",igh)
+  global mag,max_gain,max_shutter,Pi_Cam,igw,igh,camera,FUP,FDN,GPIO,still_limits,buttonFUP,buttonFDN
+  if len(cams) == 0:
+    camera_probe()
+  if camera in cams:
+    igw = cams[camera]['width']
+    igh = cams[camera]['height']
+    print(cams[camera]['sensor'],igw,"x",igh)
     if igw == 2592:
         Pi_Cam = 1
         mag = 64
@@ -283,25 +441,7 @@ def Camera_Version():
 Camera_Version()
 
 # DETERMINE NUMBER OF CAMERAS (FOR ARDUCAM MULITPLEXER)
-if os.path.exists('libcams.txt'):
-   os.rename('libcams.txt', 'oldlibcams.txt')
-os.system("libcamera-vid --list-cameras >> libcams.txt")
-time.sleep(0.5)
-# read libcams.txt file
-camstxt = []
-with open("libcams.txt", "r") as file:
-    line = file.readline()
-    while line:
-        camstxt.append(line.strip())
-        line = file.readline()
-max_camera = 0
-for x in range(0,len(camstxt)):
-    if camstxt[x][0:4] == "3 : " and max_camera < 3:
-        max_camera = 3
-    elif camstxt[x][0:4] == "2 : " and max_camera < 2:
-        max_camera = 2
-    elif camstxt[x][0:4] == "1 : " and max_camera < 1:
-        max_camera = 1
+max_camera = max(cams)
 
 if Pi_Cam == 5 or Pi_Cam == 6:
     # read /boot/config.txt file
@@ -363,6 +503,1145 @@ if shutter < 0:
 sspeed = int(shutter * 1000000)
 if (shutter * 1000000) - int(shutter * 1000000) > 0.5:
     sspeed +=1
+
+# PREVIEW FRAME PIPE
+# libcamera-vid writes the preview to stdout, a reader thread splits it into frames
+# and keeps the newest prev_ring of them, numbered so the main loop only takes new ones.
+# prev_threads decoder threads take the newest frame, decode, rotate and scale it to the preview,
+# and leave it in frame_show. Each shown frame posts FRAMEREADY (one at a time) to wake the main loop.
+FRAMEREADY  = pygame.USEREVENT + 3
+frames      = deque(maxlen=prev_ring)
+frame_seq   = 0
+frame_cond  = threading.Condition()
+frame_dec   = 0     # newest frame taken by a decoder
+frame_show  = None  # (seq,surface,Y plane or None) newest decoded frame
+frame_ready = 0     # set while a FRAMEREADY event is waiting in the queue
+frame_rotations = (None,cv2.ROTATE_90_COUNTERCLOCKWISE,cv2.ROTATE_180,cv2.ROTATE_90_CLOCKWISE)
+frame_reduced   = ((8,cv2.IMREAD_REDUCED_COLOR_8),(4,cv2.IMREAD_REDUCED_COLOR_4),(2,cv2.IMREAD_REDUCED_COLOR_2))
+frame_local     = threading.local()   # each decoder thread's yuv buffers
+frame_bufs      = 3
+
+def frame_put(data,yuv):
+    # yuv = 1 for a yuv420 frame, 0 for a jpg
+    global frame_seq
+    with frame_cond:
+        frame_seq += 1
+        frames.append((frame_seq,data,yuv))
+        frame_cond.notify_all()
+
+def frame_get(last_seq):
+    # returns (seq,surface,luma) for the newest decoded frame after last_seq, or None
+    global frame_ready
+    with frame_cond:
+        frame_ready = 0
+        if frame_show == None or frame_show[0] <= last_seq:
+            return None
+        return frame_show
+
+def frame_size(w,h):
+    # displayed size of a (rotated) w x h frame
+    if rotate == 1 or rotate == 3:
+        return int(preview_height * (w/h)),preview_height
+    if Pi_Cam == 3 and zoom < 5 and rotate == 0:
+        return preview_width,int(preview_height * 0.75)
+    return preview_width,preview_height
+
+def jpeg_size(data):
+    # width,height from the jpg SOF marker, or None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        m = data[i+1]
+        if m == 0xFF:
+            i += 1
+        elif m == 0xC0 or m == 0xC1 or m == 0xC2:
+            h,w = struct.unpack('>HH',data[i+5:i+9])
+            return w,h
+        else:
+            i += 2 + struct.unpack('>H',data[i+2:i+4])[0]
+    return None
+
+def jpeg_flag(data):
+    # libjpeg can decode at 1/2, 1/4 or 1/8 size in the DCT, use the smallest that still fills the preview.
+    size = jpeg_size(data)
+    if size == None:
+        return cv2.IMREAD_COLOR
+    for f,flag in frame_reduced:
+        w = int((size[0] + f - 1)/f)
+        h = int((size[1] + f - 1)/f)
+        if rotate == 1 or rotate == 3:
+            w,h = h,w
+        tw,th = frame_size(w,h)
+        if w >= tw and h >= th:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def frame_decode(data):
+    # jpg to a rotated RGB array at the displayed size, or None if it's not a whole frame
+    img = cv2.imdecode(np.frombuffer(data,np.uint8),jpeg_flag(data))
+    if img is None:
+        return None
+    if rotate != 0:
+        img = cv2.rotate(img,frame_rotations[rotate])
+    h,w = img.shape[:2]
+    size = frame_size(w,h)
+    if size != (w,h):
+        img = cv2.resize(img,size,interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
+
+def frame_yuv(data):
+    # yuv420 frame to (RGB array,surface) at the displayed size, or None if it's not a whole frame.
+    # The buffers are kept per decoder thread until the size changes, each thread cycles through frame_bufs
+    # of them so the surface on screen isn't written to while it's being drawn
+    if len(data) != int(yuv_w * yuv_h * 3/2):
+        return None
+    if rotate == 1 or rotate == 3:
+        rw,rh = yuv_h,yuv_w
+    else:
+        rw,rh = yuv_w,yuv_h
+    w,h = frame_size(rw,rh)
+    loc = frame_local
+    if getattr(loc,'key',None) != (yuv_w,yuv_h,rotate,w,h):
+        loc.key  = (yuv_w,yuv_h,rotate,w,h)
+        loc.rgb  = np.empty((yuv_h,yuv_w,3),np.uint8)
+        loc.rot  = np.empty((rh,rw,3),np.uint8)
+        loc.out  = [np.empty((h,w,3),np.uint8) for n in range(0,frame_bufs)]
+        loc.surf = [pygame.image.frombuffer(out,(w,h),'RGB') for out in loc.out]
+        loc.next = 0
+    n = loc.next
+    loc.next = (n + 1) % frame_bufs
+    img = np.frombuffer(data,np.uint8).reshape(int(yuv_h * 3/2),yuv_w)
+    cv2.cvtColor(img,cv2.COLOR_YUV2RGB_I420,dst=loc.rgb)
+    src = loc.rgb
+    if rotate != 0:
+        cv2.rotate(loc.rgb,frame_rotations[rotate],dst=loc.rot)
+        src = loc.rot
+    if (w,h) != (rw,rh):
+        cv2.resize(src,(w,h),dst=loc.out[n],interpolation=cv2.INTER_AREA)
+    else:
+        np.copyto(loc.out[n],src)
+    return loc.out[n],loc.surf[n]
+
+def frame_luma(data,size):
+    # the yuv420 Y plane, rotated and scaled like the frame, for the focus value
+    luma = np.frombuffer(data,np.uint8)[:yuv_w * yuv_h].reshape(yuv_h,yuv_w)
+    if rotate != 0:
+        luma = cv2.rotate(luma,frame_rotations[rotate])
+    if luma.shape[1] != size[0] or luma.shape[0] != size[1]:
+        luma = cv2.resize(luma,size,interpolation=cv2.INTER_AREA)
+    return luma
+
+def frame_surface(img):
+    return pygame.image.frombuffer(img,(img.shape[1],img.shape[0]),'RGB')
+
+def frame_decoder():
+    global frame_dec,frame_show,frame_ready
+    while True:
+        with frame_cond:
+            while len(frames) == 0 or frames[-1][0] <= frame_dec:
+                frame_cond.wait()
+            seq,data,yuv = frames[-1]
+            frame_dec = seq
+        luma = None
+        try:
+            if yuv == 1:
+                frm = frame_yuv(data)
+                if frm == None:
+                    continue
+                img,surf = frm
+                if zoom > 0 or foc_man == 1:
+                    luma = frame_luma(data,(img.shape[1],img.shape[0]))
+            else:
+                img = frame_decode(data)
+                if img is None:
+                    continue
+                surf = frame_surface(img)
+        except cv2.error:
+            continue
+        with frame_cond:
+            # a slower decoder's older frame is dropped
+            if frame_show == None or seq > frame_show[0]:
+                frame_show = (seq,surf,luma)
+                if frame_ready == 0:
+                    frame_ready = 1
+                    pygame.event.post(pygame.event.Event(FRAMEREADY))
+
+def frame_split(buf,scan):
+    # put each whole jpg in buf into the ring and remove it from buf, SOI = FFD8, EOI = FFD9.
+    # Returns where to carry on looking for the EOI when more data has been added
+    while True:
+        soi = buf.find(b'\xff\xd8')
+        if soi < 0:
+            del buf[:-1]
+            return 0
+        if soi > 0:
+            del buf[:soi]
+            scan = 0
+        eoi = buf.find(b'\xff\xd9',max(scan,2))
+        if eoi < 0:
+            return len(buf) - 1
+        frame_put(bytes(buf[:eoi+2]),0)
+        del buf[:eoi+2]
+        scan = 0
+
+def frame_reader(stream):
+    # split mjpeg stream into jpgs
+    buf  = bytearray()
+    scan = 0
+    while True:
+        data = stream.read1(65536)
+        if not data:
+            break
+        buf += data
+        scan = frame_split(buf,scan)
+    stream.close()
+
+def yuv_reader(stream,size):
+    # raw yuv420 frames are all the same size
+    while True:
+        data = stream.read(size)
+        if len(data) < size:
+            break
+        frame_put(data,1)
+    stream.close()
+
+yuv_w    = 0
+yuv_h    = 0
+
+# FOCUS ACTUATOR
+# the lens driver is opened once and driven with V4L2 ioctls instead of running v4l2-ctl for every step
+focus_dev     = "/dev/v4l-subdev1"
+focus_fd      = -1
+VIDIOC_G_CTRL = 0xc008561b
+VIDIOC_S_CTRL = 0xc008561c
+V4L2_CID_FOCUS_ABSOLUTE = 0x009a090a
+
+def focus_open():
+    global focus_fd
+    if focus_fd < 0:
+        try:
+            focus_fd = os.open(focus_dev,os.O_RDWR)
+        except OSError:
+            focus_fd = -1
+    return focus_fd
+
+def focus_close():
+    global focus_fd
+    if focus_fd >= 0:
+        os.close(focus_fd)
+    focus_fd = -1
+
+def focus_set(value):
+    if focus_open() >= 0:
+        try:
+            fcntl.ioctl(focus_fd,VIDIOC_S_CTRL,struct.pack('Ii',V4L2_CID_FOCUS_ABSOLUTE,int(value)))
+            return
+        except OSError:
+            focus_close()
+    os.system("v4l2-ctl -d " + focus_dev + " -c focus_absolute=" + str(int(value)))
+
+def focus_get():
+    if focus_open() >= 0:
+        try:
+            ctrl = bytearray(struct.pack('Ii',V4L2_CID_FOCUS_ABSOLUTE,0))
+            fcntl.ioctl(focus_fd,VIDIOC_G_CTRL,ctrl)
+            return struct.unpack('Ii',ctrl)[1]
+        except OSError:
+            focus_close()
+    try:
+        ctrl = subprocess.check_output(["v4l2-ctl","-d",focus_dev,"-C","focus_absolute"]).decode()
+        return int(ctrl.split(':')[1])
+    except (OSError,subprocess.CalledProcessError,IndexError,ValueError):
+        return None
+
+# STILL CAPTURE
+# stills are taken by a worker thread so the GUI stays live, results come back as STILLDONE events
+# and STILLEND once libcamera-still has been closed and the camera is free for the preview
+STILLDONE   = pygame.USEREVENT + 1
+STILLEND    = pygame.USEREVENT + 2
+still_queue = queue.Queue()
+still_busy  = 0     # stills queued or being taken
+still_open  = 0     # set while the worker may be using the camera
+still_last  = ""    # timestamp of the last still
+still_sub   = 0
+still_sess  = None  # libcamera-still running in signal mode
+
+def still_meta(mfile):
+    meta = {}
+    if os.path.exists(mfile):
+        with open(mfile, "r") as file:
+            for line in file:
+                check = line.strip().split("=")
+                if len(check) > 1 and (check[0] == "DigitalGain" or check[0] == "AnalogueGain" or check[0] == "ExposureTime"):
+                    meta[check[0]] = check[1]
+    return meta
+
+def still_image(fname,ext,rotate,Pi_Cam,zoom):
+    # load the captured still, save a rotated copy if required, and scale it to the preview
+    image = pygame.image.load(fname)
+    if rotate != 0:
+        image = pygame.transform.rotate(image, int(rotate * 90))
+        pygame.image.save(image,fname[:-4]+"r." + ext)
+    igwr = image.get_width()
+    ighr = image.get_height()
+    if Pi_Cam == 3 and zoom < 5 and rotate == 0:
+        image = pygame.transform.scale(image, (preview_width,int(preview_height * 0.75)))
+    elif rotate == 1 or rotate == 3:
+        image = pygame.transform.scale(image, (int(preview_height * (igwr/ighr)),preview_height))
+    else:
+        image = pygame.transform.scale(image, (preview_width,preview_height))
+    if rotate == 1 or rotate == 3:
+        return image,int((preview_width/2) - ((preview_height * (igwr/ighr)))/2)
+    return image,0
+
+def still_close():
+    # SIGUSR2 stops libcamera-still in signal mode
+    global still_sess
+    if still_sess != None and still_sess.poll() == None:
+        os.kill(still_sess.pid, signal.SIGUSR2)
+        try:
+            still_sess.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            still_sess.kill()
+            still_sess.wait()
+    still_sess = None
+
+def still_file(fnames,timeout,fd):
+    # wait for libcamera-still to close all the files in fnames, from inotify IN_CLOSE_WRITE events on fd
+    # (watched before the shot). Without inotify wait for the files to exist with a size that has stopped changing
+    left  = [os.path.basename(f) for f in fnames]
+    sizes = {}
+    start = time.monotonic()
+    ended = 0
+    while time.monotonic() - start < timeout:
+        if fd >= 0:
+            for mask,name in watch_events(fd):
+                if mask & IN_CLOSE_WRITE and name in left:
+                    left.remove(name)
+        else:
+            for f in fnames:
+                if os.path.basename(f) in left and os.path.exists(f):
+                    nsize = os.path.getsize(f)
+                    if nsize > 0 and nsize == sizes.get(f):
+                        left.remove(os.path.basename(f))
+                    sizes[f] = nsize
+        if len(left) == 0:
+            return True
+        if ended == 1:
+            return False
+        if still_sess.poll() != None:
+            # one more look for events from before it ended
+            ended = 1
+            continue
+        time.sleep(0.05)
+    return False
+
+def still_worker():
+    # the session writes to hidden names unique to this run and session, each still is renamed to its own name
+    global still_sess
+    sess_cmd   = ()
+    sess_out   = ""
+    sess_count = 0
+    sess_id    = 0
+    hold = None
+    while True:
+        try:
+            rpistr,fname,ext,prev,rotate,Pi_Cam,zoom,timeout = still_queue.get(timeout=hold)
+        except queue.Empty:
+            still_close()
+            hold = None
+            pygame.event.post(pygame.event.Event(STILLEND))
+            continue
+        hold = still_hold
+        # the preview has to release the camera first
+        try:
+            prev.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        if "--immediate" in rpistr:
+            # long exposures are taken on their own
+            still_close()
+            with open("PiLibtext.txt", "w") as mfile:
+                still_long = subprocess.Popen(rpistr + ("-t","5000","-o",fname), stdout=mfile)
+                try:
+                    ret = still_long.wait(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    still_long.kill()
+                    ret = still_long.wait()
+            ok = (ret == 0)
+        else:
+            # only restart libcamera-still if the settings have changed
+            if still_sess == None or still_sess.poll() != None or rpistr != sess_cmd:
+                still_close()
+                sess_cmd   = rpistr
+                sess_id   += 1
+                sess_out   = pic_dir + ".PiLibStill_" + str(os.getpid()) + "_" + str(sess_id) + "_%04d." + ext
+                sess_count = 0
+                with open("PiLibtext.txt", "w") as mfile:
+                    still_sess = subprocess.Popen(rpistr + ("-s","-t","0","-o",sess_out), stdout=mfile)
+                time.sleep(still_settle)
+            nfile = sess_out % sess_count
+            sess_count += 1
+            nfiles = [nfile]
+            if ext != 'dng' and ("-r" in rpistr or "--rawfull" in rpistr):
+                nfiles.append(nfile[:-len(ext)] + "dng")
+            ok = False
+            if still_sess.poll() == None:
+                fd = watch_open()
+                os.kill(still_sess.pid, signal.SIGUSR1)
+                ok = still_file(nfiles,timeout,fd)
+                if fd >= 0:
+                    os.close(fd)
+            if ok:
+                os.rename(nfile,fname)
+                if ext != 'dng' and os.path.exists(nfile[:-len(ext)] + "dng"):
+                    os.rename(nfile[:-len(ext)] + "dng",fname[:-len(ext)] + "dng")
+        image = None
+        ix = 0
+        if ok and (ext == 'jpg' or ext == 'bmp' or ext == 'png'):
+            try:
+                image,ix = still_image(fname,ext,rotate,Pi_Cam,zoom)
+            except pygame.error:
+                pass
+        pygame.event.post(pygame.event.Event(STILLDONE, fname=fname, image=image, ix=ix, meta=still_meta("PiLibtext.txt")))
+
+# stills left by a session that was killed mid-burst
+for f in glob.glob(pic_dir + ".PiLibStill_*"):
+    os.remove(f)
+threading.Thread(target=still_worker, daemon=True).start()
+
+# CAPTURE WATCHER
+# timelapse shots are counted from inotify IN_CLOSE_WRITE events on pic_dir instead of globbing the whole
+# directory, if inotify isn't available only the next expected file name is checked
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+watch_fd     = -1
+watch_prefix = ""
+watch_names  = []
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1
+except (OSError,AttributeError):
+    libc = None
+
+def watch_open():
+    # inotify fd watching pic_dir, or -1
+    if libc == None:
+        return -1
+    fd = libc.inotify_init1(os.O_NONBLOCK)
+    if fd >= 0 and libc.inotify_add_watch(fd,pic_dir.encode(),IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        fd = -1
+    return fd
+
+def watch_events(fd):
+    # (mask,name) for the events waiting on fd
+    events = []
+    while True:
+        try:
+            buf = os.read(fd,4096)
+        except BlockingIOError:
+            break
+        pos = 0
+        while pos + 16 <= len(buf):
+            wd,mask,cookie,size = struct.unpack_from('iIII',buf,pos)
+            events.append((mask,buf[pos + 16:pos + 16 + size].rstrip(b'\0').decode(errors='ignore')))
+            pos += 16 + size
+    return events
+
+def watch_start(prefix):
+    global watch_fd,watch_prefix,watch_names
+    watch_stop()
+    watch_prefix = prefix
+    watch_names  = []
+    watch_fd     = watch_open()
+
+def watch_count(nxt):
+    # files with the prefix written so far, in the order they were written, nxt = next expected file
+    if watch_fd >= 0:
+        for mask,name in watch_events(watch_fd):
+            if name[:len(watch_prefix)] == watch_prefix and pic_dir + name not in watch_names:
+                watch_names.append(pic_dir + name)
+    elif os.path.exists(nxt) and nxt not in watch_names:
+        watch_names.append(nxt)
+    return watch_names
+
+def watch_stop():
+    global watch_fd
+    if watch_fd >= 0:
+        os.close(watch_fd)
+    watch_fd = -1
+
+# PRE-RECORD
+# libcamera-vid writes h264 with the SPS/PPS repeated before every I frame (--inline, --intra fps) to a pipe.
+# The reader splits it at each SPS into GOPs of about 1 second and keeps those covering the last prerec seconds.
+# prerec_save() writes the ring to a file and the reader carries on writing the live stream to it, for vlen
+# seconds (0 = until prerec_stop()), then posts PRERECDONE.
+PRERECDONE  = pygame.USEREVENT + 5
+prerec_gops = deque()      # (start time,GOP)
+prerec_gop  = bytearray()  # GOP being read
+prerec_lock = threading.Lock()
+prerec_file = None
+prerec_end  = 0
+
+def h264_sps(buf,pos):
+    # position of the next SPS (NAL type 7) start code at or after pos, including a 4 byte start code, or -1
+    while True:
+        pos = buf.find(b'\x00\x00\x01',pos)
+        if pos < 0 or pos + 3 >= len(buf):
+            return -1
+        if buf[pos+3] & 0x1f == 7:
+            if pos > 0 and buf[pos-1] == 0:
+                return pos - 1
+            return pos
+        pos += 3
+
+def prerec_reader(stream):
+    global prerec_gop,prerec_file
+    start = time.monotonic()
+    while True:
+        data = stream.read1(65536)
+        if not data:
+            break
+        with prerec_lock:
+            if prerec_file != None:
+                prerec_file.write(data)
+                if prerec_end > 0 and time.monotonic() > prerec_end:
+                    prerec_file.close()
+                    prerec_file = None
+                    pygame.event.post(pygame.event.Event(PRERECDONE))
+                continue
+            prerec_gop += data
+            pos = h264_sps(prerec_gop,max(len(prerec_gop) - len(data) - 4,1))
+            while pos >= 0:
+                if pos > 0:
+                    prerec_gops.append((start,bytes(prerec_gop[:pos])))
+                    del prerec_gop[:pos]
+                    start = time.monotonic()
+                pos = h264_sps(prerec_gop,4)
+            while len(prerec_gops) > 1 and prerec_gops[1][0] <= time.monotonic() - prerec:
+                prerec_gops.popleft()
+    stream.close()
+
+def prerec_begin():
+    global prerec_gop,prerec_file
+    with prerec_lock:
+        prerec_gops.clear()
+        prerec_gop  = bytearray()
+        prerec_file = None
+
+def prerec_secs():
+    # seconds of video held
+    with prerec_lock:
+        if len(prerec_gops) == 0:
+            return 0
+        return time.monotonic() - prerec_gops[0][0]
+
+def prerec_save(vname,vlen):
+    global prerec_file,prerec_end
+    with prerec_lock:
+        prerec_file = open(vname,'wb')
+        for t,gop in prerec_gops:
+            prerec_file.write(gop)
+        prerec_file.write(prerec_gop)
+        prerec_gops.clear()
+        prerec_end = 0
+        if vlen > 0:
+            prerec_end = time.monotonic() + vlen
+
+def prerec_stop():
+    global prerec_file
+    with prerec_lock:
+        if prerec_file != None:
+            prerec_file.close()
+        prerec_file = None
+
+# VIDEO TEE
+# with vid_tee = 1 libcamera-vid records to stdout, the reader writes it to the file and also passes it to the preview.
+# mjpeg is split into whole jpgs for the preview ring, which keeps the newest. h264 goes through a small queue to
+# ffmpeg decoding it to small mjpeg frames, when the queue is full the rest of that GOP is dropped and it carries
+# on from the next SPS, so ffmpeg only ever sees whole GOPs. The recording is never held up.
+tee_ffmpeg = shutil.which("ffmpeg")
+
+def tee_reader(stream,vname,tq):
+    # tq = None for mjpeg
+    buf  = bytearray()
+    scan = 0
+    skip = 0
+    with open(vname,'wb') as f:
+        while True:
+            data = stream.read1(65536)
+            if not data:
+                break
+            f.write(data)
+            if tq == None:
+                buf += data
+                scan = frame_split(buf,scan)
+                continue
+            if skip == 1:
+                # the last 5 bytes are kept in case an SPS start code is split between reads
+                buf += data
+                pos = h264_sps(buf,0)
+                if pos < 0:
+                    del buf[:-5]
+                    continue
+                data = bytes(buf[pos:])
+                skip = 0
+            try:
+                tq.put_nowait(data)
+            except queue.Full:
+                buf  = bytearray(data[-5:])
+                skip = 1
+    stream.close()
+    if tq == None:
+        return
+    while True:
+        try:
+            tq.put_nowait(None)
+            break
+        except queue.Full:
+            tq.get_nowait()
+
+def tee_feed(tq,dst):
+    while True:
+        data = tq.get()
+        if data == None:
+            break
+        try:
+            dst.write(data)
+            dst.flush()
+        except (OSError,ValueError):
+            pass
+    try:
+        dst.close()
+    except OSError:
+        pass
+
+def tee_start(stream,vname):
+    # start the recording and preview threads, returns the ffmpeg process or None and the recording thread
+    with frame_cond:
+        frames.clear()
+    tq = None
+    ff = None
+    if codecs[codec] == 'h264':
+        tq = queue.Queue(maxsize=16)
+        ff = subprocess.Popen([tee_ffmpeg,"-loglevel","quiet","-f","h264","-i","pipe:0","-vf","fps=" + str(min(fps,prev_fps)) + ",scale=" + str(preview_width) + ":-2",
+                               "-q:v","5","-f","mjpeg","pipe:1"],stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+        threading.Thread(target=frame_reader, args=(ff.stdout,), daemon=True).start()
+        threading.Thread(target=tee_feed, args=(tq,ff.stdin), daemon=True).start()
+    tw = threading.Thread(target=tee_reader, args=(stream,vname,tq), daemon=True)
+    tw.start()
+    return ff,tw
+
+# STREAM SERVER
+# libcamera-vid writes h264 with inline headers to stdout, a reader thread hands it to an asyncio loop which copies
+# it to every viewer's queue. New viewers get the GOP so far, so they start on a key frame, or wait for the next SPS.
+# A viewer whose queue fills up is dropped rather than holding up the others. Viewers that send an http request
+# get an http reply first, others (eg vlc tcp/h264://pi:5000) just get the h264
+stream_conns = {}          # writer : [queue,task,joined]
+stream_gop   = bytearray() # from the last SPS
+
+def stream_fanout(data,key):
+    if key:
+        del stream_gop[:]
+    if key or len(stream_gop) > 0:
+        stream_gop.extend(data)
+    if len(stream_gop) > 8000000:
+        del stream_gop[:]
+    for writer,conn in list(stream_conns.items()):
+        if conn[2] < 0:
+            continue
+        if conn[2] == 0:
+            if not key:
+                continue
+            conn[2] = 1
+        try:
+            conn[0].put_nowait(data)
+        except asyncio.QueueFull:
+            del stream_conns[writer]
+            conn[1].cancel()
+
+async def stream_client(reader,writer):
+    # counted as soon as it's accepted, conn[2] = -1 until it has said whether it's http
+    if len(stream_conns) >= stream_max:
+        writer.close()
+        return
+    conn = [asyncio.Queue(maxsize=stream_queue),asyncio.current_task(),-1]
+    stream_conns[writer] = conn
+    try:
+        try:
+            line = await asyncio.wait_for(reader.readline(),0.5)
+        except (asyncio.TimeoutError,ConnectionError):
+            line = b""
+        if line.startswith(b"GET"):
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: video/h264\r\nCache-Control: no-cache\r\n\r\n")
+        if len(stream_gop) > 0:
+            conn[0].put_nowait(bytes(stream_gop))
+            conn[2] = 1
+        else:
+            conn[2] = 0
+        while True:
+            data = await conn[0].get()
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError,OSError,asyncio.CancelledError):
+        pass
+    finally:
+        stream_conns.pop(writer,None)
+        writer.close()
+
+def stream_reader(stream,loop,done):
+    # the data is split at every SPS, key = True for a piece starting with one. The last 5 bytes are held back
+    # until the next read in case a start code is split between reads
+    buf = bytearray()
+    key = False
+    while True:
+        data = stream.read1(65536)
+        if not data:
+            break
+        buf += data
+        pos = h264_sps(buf,max(len(buf) - len(data) - 4,0))
+        while pos >= 0:
+            if pos > 0:
+                loop.call_soon_threadsafe(stream_fanout,bytes(buf[:pos]),key)
+                del buf[:pos]
+            key = True
+            pos = h264_sps(buf,4)
+        if len(buf) > 5:
+            loop.call_soon_threadsafe(stream_fanout,bytes(buf[:-5]),key)
+            del buf[:-5]
+            key = False
+    if len(buf) > 0:
+        loop.call_soon_threadsafe(stream_fanout,bytes(buf),key)
+    stream.close()
+    loop.call_soon_threadsafe(done.set)
+
+async def stream_main(stream):
+    done   = asyncio.Event()
+    server = await asyncio.start_server(stream_client,"0.0.0.0",stream_port,reuse_address=True)
+    threading.Thread(target=stream_reader, args=(stream,asyncio.get_running_loop(),done), daemon=True).start()
+    await done.wait()
+    server.close()
+    for writer,conn in list(stream_conns.items()):
+        conn[1].cancel()
+    stream_conns.clear()
+    del stream_gop[:]
+    await server.wait_closed()
+
+def stream_serve(stream):
+    # runs until libcamera-vid's stdout closes
+    asyncio.run(stream_main(stream))
+
+def stream_count():
+    return len(stream_conns)
+
+# WEB PREVIEW
+# serves the newest frame in the preview ring as multipart/x-mixed-replace, each browser at up to web_fps.
+# Preview jpgs go out untouched, only yuv previews (prev_pipe = 2) are encoded, once a frame however many browsers.
+# With prev_pipe = 0 the main loop puts the jpgs it reads from /run/shm in the ring.
+# The frames are as libcamera-vid gives them, so the page rotates them to match the GUI.
+web_conns = 0
+web_jpg   = (0,None)   # (seq,jpg) last frame encoded from yuv
+web_turns = ("","rotate(-90deg)","rotate(180deg)","rotate(90deg)")
+
+def web_frame(last_seq):
+    # (seq,jpg) for the newest preview frame after last_seq, or None
+    global web_jpg
+    with frame_cond:
+        if len(frames) == 0 or frames[-1][0] <= last_seq:
+            return None
+        seq,data,yuv = frames[-1]
+    if yuv == 0:
+        return seq,data
+    if web_jpg[0] != seq:
+        if len(data) != int(yuv_w * yuv_h * 3/2):
+            return None
+        img = np.frombuffer(data,np.uint8).reshape(int(yuv_h * 3/2),yuv_w)
+        ok,jpg = cv2.imencode('.jpg',cv2.cvtColor(img,cv2.COLOR_YUV2BGR_I420),[cv2.IMWRITE_JPEG_QUALITY,80])
+        if not ok:
+            return None
+        web_jpg = (seq,jpg.tobytes())
+    return web_jpg
+
+async def web_client(reader,writer):
+    global web_conns
+    try:
+        line = await asyncio.wait_for(reader.readline(),5)
+        while True:
+            head = await asyncio.wait_for(reader.readline(),5)
+            if head in (b"\r\n",b"\n",b""):
+                break
+    except (asyncio.TimeoutError,ConnectionError):
+        writer.close()
+        return
+    path = line.split(b" ")[1] if len(line.split(b" ")) > 1 else b"/"
+    try:
+        if path.startswith(b"/stream"):
+            if web_conns >= web_max:
+                writer.write(b"HTTP/1.0 503 Service Unavailable\r\n\r\n")
+                await writer.drain()
+                return
+            web_conns += 1
+            try:
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                             + b"Cache-Control: no-cache\r\n\r\n")
+                last = 0
+                while True:
+                    frm = web_frame(last)
+                    if frm == None:
+                        await asyncio.sleep(0.02)
+                        continue
+                    last,jpg = frm
+                    writer.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(jpg)).encode()
+                                 + b"\r\n\r\n" + jpg + b"\r\n")
+                    await writer.drain()
+                    await asyncio.sleep(1/web_fps)
+            finally:
+                web_conns -= 1
+        elif path.startswith(b"/jpg"):
+            frm = web_frame(0)
+            if frm == None:
+                writer.write(b"HTTP/1.0 503 Service Unavailable\r\n\r\n")
+            else:
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(frm[1])).encode()
+                             + b"\r\nCache-Control: no-cache\r\n\r\n" + frm[1])
+            await writer.drain()
+        else:
+            page = ("<html><head><title>" + cameras[Pi_Cam] + "</title></head><body style='background:black;margin:0'>"
+                    + "<img src='/stream' style='display:block;margin:auto;transform:" + web_turns[rotate] + "'>"
+                    + "</body></html>").encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\nContent-Length: " + str(len(page)).encode()
+                         + b"\r\n\r\n" + page)
+            await writer.drain()
+    except (ConnectionError,OSError):
+        pass
+    finally:
+        writer.close()
+
+async def web_main():
+    server = await asyncio.start_server(web_client,"0.0.0.0",web_port,reuse_address=True)
+    await server.serve_forever()
+
+def web_serve():
+    asyncio.run(web_main())
+
+# CAMERA COMMANDS
+# one builder for the preview, still, timelapse, video and stream command lines. It returns an argv tuple
+# to run without a shell and is cached on the settings, so it is only rebuilt when something changes.
+# kind = 'preview', 'still', 'tlstill', 'video', 'stream' or 'tlvid', bin2 = 1 for 16MP 2x2 binned stills
+def prev_size(igw,igh,Pi_Cam,rotate):
+    # smallest preview that covers the displayed image at the sensor's aspect ratio, the ISP does the scaling.
+    # width a multiple of 64 so yuv420 rows are not padded
+    if rotate == 1 or rotate == 3:
+        w = preview_height
+    elif Pi_Cam == 3:
+        w = max(preview_width,preview_height * 0.75 * igw/igh)
+    else:
+        w = max(preview_width,preview_height * igw/igh)
+    w = math.ceil(w/64) * 64
+    h = math.ceil(w * igh/igw/2) * 2
+    return w,h
+
+def prev_mode(camera,w,h):
+    # smallest full field of view sensor mode giving at least w x h, so libcamera doesn't choose a cropped one
+    if camera not in cams:
+        return None
+    full = None
+    for mw,mh,bits,mfps,cw,ch in cams[camera]['modes']:
+        if cw * 20 >= cams[camera]['width'] * 19 and ch * 20 >= cams[camera]['height'] * 19 and mw >= w and mh >= h:
+            if full == None or mw * mh < full[0] * full[1]:
+                full = (mw,mh,bits)
+    if full == None:
+        return None
+    return str(full[0]) + ":" + str(full[1]) + ":" + str(full[2])
+
+def camera_cmd(kind,bin2=0):
+    return camera_argv(kind,bin2,(camera,Pi_Cam,mode,sspeed,gain,ev,brightness,contrast,awb,red,blue,meter,saturation,sharpness,denoise,quality,
+        foc_man,focus_mode,v3_f_mode,v3_focus,v3_f_speed,v3_f_range,v3_hdr,fxx,fxy,fxz,zoom,igw,igh,scientific,extn,codec,fps,vwidth,vheight,
+        profile,vpreview,tinterval,prev_fps,focus_fps,rotate))
+
+@lru_cache(maxsize=32)
+def camera_argv(kind,bin2,settings):
+    (camera,Pi_Cam,mode,sspeed,gain,ev,brightness,contrast,awb,red,blue,meter,saturation,sharpness,denoise,quality,
+        foc_man,focus_mode,v3_f_mode,v3_focus,v3_f_speed,v3_f_range,v3_hdr,fxx,fxy,fxz,zoom,igw,igh,scientific,extn,codec,fps,vwidth,vheight,
+        profile,vpreview,tinterval,prev_fps,focus_fps,rotate) = settings
+    still = (kind == 'still' or kind == 'tlstill')
+    video = (kind == 'video' or kind == 'stream')
+    # command, output format and size
+    if kind == 'preview':
+        cmd = ["libcamera-vid","--camera",str(camera),"-n","-t","0"]
+        if prev_pipe == 2:
+            cmd += ["--codec","yuv420"]
+        else:
+            cmd += ["--codec","mjpeg"]
+        # the ISP scales to the preview size, the focus value is taken from the displayed frame.
+        # Zoom and focus modes read a larger sensor mode so the crop and the focus value keep their detail
+        w,h = prev_size(igw,igh,Pi_Cam,rotate)
+        cmd += ["--width",str(w),"--height",str(h)]
+        if (Pi_Cam == 5 or Pi_Cam == 6) and focus_mode == 1:
+            smode = prev_mode(camera,3280,2464)
+        elif (zoom > 0 or focus_mode == 1 or foc_man == 1) and Pi_Cam == 7:
+            smode = prev_mode(camera,1456,1088)
+        elif (zoom > 0 or focus_mode == 1 or foc_man == 1) and Pi_Cam == 3:
+            smode = prev_mode(camera,2304,1296)
+        elif zoom > 0 or focus_mode == 1 or foc_man == 1:
+            smode = prev_mode(camera,1920,1440)
+        else:
+            smode = prev_mode(camera,w,h)
+        if smode != None:
+            cmd += ["--mode",smode]
+        if prev_pipe == 0:
+            cmd += ["--segment","1","-o","/run/shm/test%d.jpg"]
+        else:
+            cmd += ["--flush","-o","-"]
+    elif still:
+        cmd = ["libcamera-still","--camera",str(camera)]
+        if extns[extn] != 'raw':
+            cmd += ["-e",extns[extn],"-n"]
+        else:
+            cmd += ["-r","-n"]
+        if preview_width == 640 and preview_height == 480 and (zoom == 4 or (kind == 'tlstill' and zoom > 4)):
+            if extns[extn] == 'raw':
+                cmd += ["--rawfull"]
+            elif extns[extn] == 'jpg':
+                cmd += ["-r","--rawfull"]
+        if Pi_Cam == 6 and bin2 == 1:
+            cmd += ["--width","4624","--height","3472"] # 16MP superpixel mode for higher light sensitivity
+        elif Pi_Cam == 6:
+            cmd += ["--width","9152","--height","6944"]
+    elif kind == 'tlvid':
+        if codecs2[codec] != 'raw':
+            cmd = ["libcamera-vid","--camera",str(camera),"-n","--codec","mjpeg"]
+        else:
+            cmd = ["libcamera-raw","--camera",str(camera),"-n"]
+        if zoom > 0:
+            cmd += ["--width",str(preview_width),"--height",str(preview_height)]
+        else:
+            cmd += ["--width",str(vwidth),"--height",str(vheight)]
+    else:
+        if kind == 'stream' or codecs2[codec] != 'raw':
+            cmd = ["libcamera-vid","--camera",str(camera)]
+            if kind == 'stream':
+                cmd += ["--inline","--listen"]
+            if mode != 0:
+                cmd += ["--framerate",str(fps)]
+            else:
+                speed7 = sspeed
+                speed7 = max(speed7,int((1/fps)*1000000))
+                cmd += ["--framerate",str(int((1/speed7)*1000000))]
+            prof = h264profiles[profile].split(" ")
+            if kind == 'stream':
+                cmd += ["--profile",str(prof[0]),"--level",str(prof[1])]
+            elif codecs[codec] != 'h264' and codecs[codec] != 'mp4':
+                cmd += ["--codec",codecs[codec]]
+            else:
+                cmd += ["--level",str(prof[1])]
+        else:
+            cmd = ["libcamera-raw","--camera",str(camera),"--framerate",str(fps)]
+        if vpreview == 0:
+            cmd += ["-n"]
+        if zoom > 0:
+            cmd += ["--width",str(preview_width),"--height",str(preview_height)]
+        elif Pi_Cam == 4 and vwidth == 2028:
+            cmd += ["--mode","2028:1520:12"]
+        elif Pi_Cam == 3 and vwidth == 2304 and codec == 0:
+            cmd += ["--mode","2304:1296:10","--width","2304","--height","1296"]
+        elif Pi_Cam == 3 and vwidth == 2028 and codec == 0:
+            cmd += ["--mode","2028:1520:10","--width","2028","--height","1520"]
+        else:
+            cmd += ["--width",str(vwidth),"--height",str(vheight)]
+        cmd += ["-p","0,0," + str(preview_width) + "," + str(preview_height)]
+    cmd += ["--brightness",str(brightness/100),"--contrast",str(contrast/100)]
+    # exposure
+    if mode != 0:
+        cmd += ["--exposure",str(modes[mode])]
+    elif kind == 'preview':
+        cmd += ["--shutter",str(min(sspeed,2000000))]
+    else:
+        cmd += ["--shutter",str(sspeed)]
+    if kind == 'preview':
+        if zoom > 4 and (Pi_Cam < 5 or Pi_Cam == 7) and Pi_Cam != 3 and mode != 0:
+            cmd += ["--framerate",str(focus_fps)]
+        elif (zoom < 5 or Pi_Cam == 3) and mode != 0:
+            cmd += ["--framerate",str(prev_fps)]
+        elif mode == 0:
+            cmd += ["--framerate",str(min(1000000/min(sspeed,2000000),25))]
+    elif kind == 'tlvid':
+        if mode == 0:
+            cmd += ["--framerate",str(1000000/sspeed)]
+        else:
+            cmd += ["--framerate",str(fps)]
+    if ev != 0:
+        cmd += ["--ev",str(ev)]
+    # gain and white balance, long exposures use fixed awb gains
+    if kind == 'preview' and sspeed > 5000000 and mode == 0:
+        cmd += ["--gain","1","--awbgains",str(red/10) + "," + str(blue/10)]
+    elif still and sspeed > 1000000 and mode == 0 and (Pi_Cam < 5 or Pi_Cam == 7):
+        cmd += ["--gain",str(gain),"--immediate","--awbgains",str(red/10) + "," + str(blue/10)]
+    elif kind == 'tlvid' and sspeed > 5000000 and mode == 0 and (Pi_Cam < 5 or Pi_Cam == 7):
+        cmd += ["--gain","1","--immediate","--awbgains",str(red/10) + "," + str(blue/10)]
+    else:
+        cmd += ["--gain",str(gain)]
+        if awb == 0:
+            cmd += ["--awbgains",str(red/10) + "," + str(blue/10)]
+        else:
+            cmd += ["--awb",awbs[awb]]
+    cmd += ["--metering",meters[meter]]
+    cmd += ["--saturation",str(saturation/10)]
+    cmd += ["--sharpness",str(sharpness/10)]
+    cmd += ["--denoise",denoises[denoise]]
+    if kind == 'preview' or still:
+        cmd += ["--quality",str(quality)]
+    # focus
+    if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0 and (kind != 'tlstill' or tinterval > 5):
+        cmd += ["--autofocus"]
+    if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
+        cmd += ["--autofocus-mode",v3_f_modes[v3_f_mode]]
+        if v3_f_mode == 1:
+            cmd += ["--lens-position",str(v3_focus/100)]
+    elif Pi_Cam == 3 and still and v3_f_mode == 0 and fxz == 1:
+        cmd += ["--autofocus-mode",v3_f_modes[v3_f_mode],"--autofocus-on-capture"]
+    elif Pi_Cam == 3 and zoom == 0 and (still or kind == 'tlvid' or (fxx != 0 and v3_f_mode != 1)):
+        cmd += ["--autofocus-window",str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)]
+    if Pi_Cam == 3 and (kind == 'preview' or video):
+        if v3_f_speed != 0:
+            cmd += ["--autofocus-speed",v3_f_speeds[v3_f_speed]]
+        if v3_f_range != 0:
+            cmd += ["--autofocus-range",v3_f_ranges[v3_f_range]]
+    if v3_hdr == 1 and (Pi_Cam == 3 or still):
+        cmd += ["--hdr"]
+    if kind == 'preview' and Pi_Cam == 4 and scientific == 1:
+        cmd += ["--tuning-file","/usr/share/libcamera/ipa/rpi/vc4/imx477_scientific.json"]
+    # zoom
+    if kind == 'preview' and zoom > 1 and zoom < 5:
+        zxo = ((1920-zwidths[4 - zoom])/2)/1920
+        zyo = ((1440-zheights[4 - zoom])/2)/1440
+        cmd += ["--roi",str(zxo) + "," + str(zyo) + "," + str(zwidths[4 - zoom]/1920) + "," + str(zheights[4 - zoom]/1440)]
+    elif video and zoom > 0 and zoom < 5:
+        zxo = ((1920-zwidths[4 - zoom])/2)/1920
+        zyo = ((1440-zheights[4 - zoom])/2)/1440
+        cmd += ["--mode","1920:1440:10","--roi",str(zxo) + "," + str(zyo) + "," + str(zwidths[4 - zoom]/1920) + "," + str(zheights[4 - zoom]/1440)]
+    elif (still or kind == 'tlvid') and zoom > 0 and zoom < 5:
+        zxo = ((igw-zws[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igw
+        zyo = ((igh-zhs[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igh
+        if kind == 'tlvid':
+            cmd += ["--mode","1920:1440:10"]
+        cmd += ["--roi",str(zxo) + "," + str(zyo) + "," + str(zws[(4-zoom) + ((Pi_Cam-1)* 4)]/igw) + "," + str(zhs[(4-zoom) + ((Pi_Cam-1)* 4)]/igh)]
+    if zoom == 5:
+        zxo = ((igw/2)-(preview_width/2))/igw
+        zyo = ((igh/2)-(preview_height/2))/igh
+        cmd += ["--roi",str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)]
+    if kind == 'still':
+        cmd += ["--metadata","-","--metadata-format","txt"]
+    return tuple(cmd)
+
+# HEADLESS
+# python3 PiLibCameraGUI.py --headless still | timelapse | video | stream | preview
+# runs one job with the settings saved in the config file (set them up in the GUI) and exits, without opening
+# a display or drawing the GUI, for Pi Zeros and cameras without a screen. ctrl-c or SIGTERM stops it.
+# preview serves the preview to browsers on web_port (8080 if it's 0) until stopped.
+def headless_wait(p):
+    try:
+        return p.wait()
+    except KeyboardInterrupt:
+        os.killpg(p.pid, signal.SIGTERM)
+        p.wait()
+        return -1
+
+def headless_job(job):
+    global fxx,fxy,fxz,vpreview,prev_pipe,web_port
+    fxx = 0
+    fxy = 0
+    fxz = 1
+    vpreview = 0
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    timestamp = datetime.datetime.now().strftime("%y%m%d%H%M%S")
+    if job == "still":
+        fname = pic_dir + timestamp + '.' + extns2[extn]
+        rpistr = camera_cmd('still') + ("-t",str(still_settle * 1000),"-o",fname)
+        if "--immediate" in rpistr:
+            rpistr = camera_cmd('still') + ("-t","5000","-o",fname)
+        p = subprocess.Popen(rpistr, preexec_fn=os.setsid, stdout=subprocess.DEVNULL)
+        if headless_wait(p) != 0:
+            return 1
+        print(fname)
+    elif job == "timelapse" and tinterval > 0 and mode != 0:
+        # one libcamera-still in signal mode, SIGUSR1 for each shot
+        fname = pic_dir + timestamp + '_%04d.' + extns2[extn]
+        watch_start(timestamp)
+        p = subprocess.Popen(camera_cmd('tlstill') + ("-s","-t","0","-o",fname), preexec_fn=os.setsid)
+        count = 0
+        try:
+            time.sleep(still_settle)
+            while count < tshots and p.poll() == None:
+                start = time.monotonic()
+                os.kill(p.pid, signal.SIGUSR1)
+                while len(watch_count(fname % count)) == count and p.poll() == None:
+                    time.sleep(0.1)
+                print(fname % count)
+                count += 1
+                if count < tshots:
+                    time.sleep(max(tinterval - (time.monotonic() - start),0))
+        except KeyboardInterrupt:
+            pass
+        watch_stop()
+        if p.poll() == None:
+            os.killpg(p.pid, signal.SIGTERM)
+            p.wait()
+    elif job == "timelapse" and tinterval > 0:
+        # manual exposures, libcamera-still for each shot
+        for count in range(0,tshots):
+            start = time.monotonic()
+            fname = pic_dir + timestamp + "_" + str(count) + "." + extns2[extn]
+            p = subprocess.Popen(camera_cmd('tlstill') + ("-t","1000","-o",fname), preexec_fn=os.setsid)
+            if headless_wait(p) < 0:
+                break
+            print(fname)
+            try:
+                if count < tshots - 1:
+                    time.sleep(max(tinterval - (time.monotonic() - start),0))
+            except KeyboardInterrupt:
+                break
+    elif job == "timelapse":
+        fname = pic_dir + timestamp + '_%04d.' + extns2[extn]
+        if codecs2[codec] == 'raw':
+            fname = pic_dir + timestamp + '_%04d.' + codecs2[codec]
+        p = subprocess.Popen(camera_cmd('tlvid') + ("-t",str(max(tduration,1) * 1000),"--segment","1","-o",fname), preexec_fn=os.setsid)
+        headless_wait(p)
+    elif job == "video":
+        vname = vid_dir + timestamp + "." + codecs2[codec]
+        p = subprocess.Popen(camera_cmd('video') + ("-t",str(vlen * 1000),"-o",vname), preexec_fn=os.setsid)
+        headless_wait(p)
+        print(vname)
+    elif job == "stream" and stream_fan == 1:
+        rpistr = tuple([a for a in camera_cmd('stream') if a != "--listen"]) + ("-t",str(vlen * 1000),"-o","-")
+        p = subprocess.Popen(rpistr, preexec_fn=os.setsid, stdout=subprocess.PIPE)
+        fan = threading.Thread(target=stream_serve, args=(p.stdout,), daemon=True)
+        fan.start()
+        headless_wait(p)
+        fan.join(2)
+    elif job == "stream":
+        rpistr = camera_cmd('stream') + ("-t",str(vlen * 1000),"-o","tcp://0.0.0.0:" + str(stream_port))
+        headless_wait(subprocess.Popen(rpistr, preexec_fn=os.setsid))
+    elif job == "preview":
+        if web_port == 0:
+            web_port = 8080
+        # browsers want jpgs, so always the mjpeg pipe
+        prev_pipe = 1
+        p = subprocess.Popen(camera_cmd('preview'), preexec_fn=os.setsid, stdout=subprocess.PIPE)
+        threading.Thread(target=frame_reader, args=(p.stdout,), daemon=True).start()
+        threading.Thread(target=web_serve, daemon=True).start()
+        print("http://" + os.uname()[1] + ":" + str(web_port) + "/")
+        headless_wait(p)
+    else:
+        print("usage: python3 " + sys.argv[0] + " --headless still | timelapse | video | stream | preview")
+        return 2
+    return 0
+
+if len(sys.argv) > 2 and sys.argv[1] == "--headless":
+    sys.exit(headless_job(sys.argv[2]))
+
 pygame.init()
 if frame == 1:
     if sq_dis == 0 and fullscreen == 1:
@@ -377,6 +1656,23 @@ else:
     else:
         windowSurfaceObj = pygame.display.set_mode((preview_width,dis_height), pygame.NOFRAME, 24)
 pygame.display.set_caption('Pi LibCamera GUI')
+# the main loop sleeps in pygame.event.wait(), mouse moves alone don't need to wake it
+pygame.event.set_blocked(MOUSEMOTION)
+
+# GPIO FOCUS BUTTONS
+# gpiozero calls these from its own thread on press, and every hold_time while held
+FOCUSSTEP = pygame.USEREVENT + 4
+
+def focus_up():
+    pygame.event.post(pygame.event.Event(FOCUSSTEP,step=1))
+
+def focus_down():
+    pygame.event.post(pygame.event.Event(FOCUSSTEP,step=-1))
+
+buttonFUP.when_pressed = focus_up
+buttonFUP.when_held    = focus_up
+buttonFDN.when_pressed = focus_down
+buttonFDN.when_held    = focus_down
 
 global greyColor, redColor, greenColor, blueColor, dgryColor, lgrnColor, blackColor, whiteColor, purpleColor, yellowColor,lpurColor,lyelColor
 bredColor =   pygame.Color(255,   0,   0)
@@ -393,6 +1689,17 @@ yellowColor = pygame.Color(255, 255,   0)
 blueColor =   pygame.Color(  0,   0, 255)
 redColor =    pygame.Color(200,   0,   0)
 
+# DISPLAY UPDATES
+# drawing functions add the rects they change to dirty, which are pushed to the screen together by display_flush(),
+# once per pass of the main loop (and of the video / timelapse loops). text() with upd = 0 leaves its rect out,
+# for overlays on the preview which goes out whole
+dirty = []
+
+def display_flush():
+    if len(dirty) > 0:
+        pygame.display.update(dirty)
+        del dirty[:]
+
 def button(col,row, bkgnd_Color,border_Color):
     global preview_width,bw,bh,sq_dis
     colors = [greyColor, dgryColor,yellowColor,purpleColor,greenColor,whiteColor,lgrnColor,lpurColor,lyelColor,blueColor]
@@ -419,9 +1726,23 @@ def button(col,row, bkgnd_Color,border_Color):
     pygame.draw.line(windowSurfaceObj,greyColor,(bx+bw-1,by),(bx+bw-1,by+bh))
     pygame.draw.line(windowSurfaceObj,colors[border_Color],(bx,by),(bx,by+bh-1))
     pygame.draw.line(windowSurfaceObj,dgryColor,(bx,by+bh-1),(bx+bw-1,by+bh-1))
-    pygame.display.update(bx, by, bw, bh)
+    dirty.append(Rect(bx, by, bw, bh))
     return
 
+# TEXT CACHE
+# fonts are loaded once per size and rendered labels are kept, so redrawing a label is just a blit
+font_file = '/usr/share/fonts/truetype/freefont/FreeSerif.ttf'
+if not os.path.exists(font_file):
+    font_file = None
+
+@lru_cache(maxsize=None)
+def font(fsize):
+    return pygame.font.Font(font_file, fsize)
+
+@lru_cache(maxsize=512)
+def label(msg,fsize,rgb):
+    return font(fsize).render(msg, False, rgb)
+
 def text(col,row,fColor,top,upd,msg,fsize,bkgnd_Color):
     global bh,preview_width,fv,tduration
     colors =  [dgryColor, greenColor, yellowColor, redColor, purpleColor, blueColor, whiteColor, greyColor, blackColor, purpleColor,lgrnColor,lpurColor,lyelColor]
@@ -444,11 +1765,7 @@ def text(col,row,fColor,top,upd,msg,fsize,bkgnd_Color):
         else:
             bx = (row - 7) * bw
             by = preview_height + (bh*3)
-    if os.path.exists ('/usr/share/fonts/truetype/freefont/FreeSerif.ttf'): 
-        fontObj = pygame.font.Font('/usr/share/fonts/truetype/freefont/FreeSerif.ttf', int(fsize))
-    else:
-        fontObj = pygame.font.Font(None, int(fsize))
-    msgSurfaceObj = fontObj.render(msg, False, Color)
+    msgSurfaceObj = label(msg, int(fsize), tuple(Color))
     msgRectobj = msgSurfaceObj.get_rect()
     if top == 0:
         pygame.draw.rect(windowSurfaceObj,bColor,Rect(bx+1,by+int(bh/3),bw-2,int(bh/3)))
@@ -462,12 +1779,14 @@ def text(col,row,fColor,top,upd,msg,fsize,bkgnd_Color):
     elif top == 2:
         if bkgnd_Color == 1:
             pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,row * fsize,preview_width,fv*2))
+            if upd == 1:
+                dirty.append(Rect(0,row * fsize,preview_width,fv*2))
         msgRectobj.topleft = (0,row * fsize)
     windowSurfaceObj.blit(msgSurfaceObj, msgRectobj)
     if upd == 1 and top == 2:
-        pygame.display.update(0,0,preview_width,fv*2)
-    if upd == 1:
-        pygame.display.update(bx, by, bw, bh)
+        dirty.append(msgRectobj)
+    elif upd == 1:
+        dirty.append(Rect(bx, by, bw, bh))
 
 def draw_bar(col,row,color,msg,value):
     global bw,bh,preview_width,still_limits,max_speed,v3_mag
@@ -503,7 +1822,12 @@ def draw_bar(col,row,color,msg,value):
         else:
             pygame.draw.rect(windowSurfaceObj,(150,120,150),Rect(int(((row-6)*bw) + 2),int(preview_height + bh),int(j+1),int(bh/3)))
             pygame.draw.rect(windowSurfaceObj,(155,0,150),Rect(int(((row-6)*bw) + j) ,int(preview_height +  bh),3,int(bh/3)))
-    pygame.display.update()
+    if sq_dis == 0:
+        dirty.append(Rect(preview_width + col*bw,row * bh,bw,int(bh/3)))
+    elif row < 6:
+        dirty.append(Rect(row*bw,preview_height,bw,int(bh/3)))
+    else:
+        dirty.append(Rect((row-6)*bw,preview_height + bh,bw,int(bh/3)))
 
 def draw_Vbar(col,row,color,msg,value):
     global bw,bh,preview_width,video_limits
@@ -535,84 +1859,236 @@ def draw_Vbar(col,row,color,msg,value):
         else:
             pygame.draw.rect(windowSurfaceObj,(150,120,150),Rect(int(((row-7)*bw) + 2),int(preview_height +  + (bh*3)),int(j+1),int(bh/3)))
             pygame.draw.rect(windowSurfaceObj,(155,0,150),Rect(int(((row-7)*bw) + j) ,int(preview_height +  + (bh*3)),3,int(bh/3)))
-    pygame.display.update()
+    if sq_dis == 0:
+        dirty.append(Rect(preview_width + col*bw,row * bh,bw,int(bh/3)))
+    elif row < 7:
+        dirty.append(Rect(row*bw,preview_height + (bh*2),bw,int(bh/3)))
+    else:
+        dirty.append(Rect((row-7)*bw,preview_height + (bh*3),bw,int(bh/3)))
 
-def preview():
-    global scientif,scientific,fxx,fxy,fxz,v3_focus,v3_hdr,v3_f_mode,v3_f_modes,prev_fps,focus_fps,focus_mode,restart,rpistr,count,p, brightness,contrast,modes,mode,red,blue,gain,sspeed,ev,preview_width,preview_height,zoom,igw,igh,zx,zy,awbs,awb,saturations,saturation,meters,meter,flickers,flicker,sharpnesss,sharpness,rotate
-    files = glob.glob('/run/shm/*.jpg')
-    for f in files:
-        os.remove(f)
-    speed2 = sspeed
-    speed2 = min(speed2,2000000)
-    rpistr = "libcamera-vid --camera " + str(camera) + " -n --codec mjpeg -t 0 --segment 1"
-    if (Pi_Cam == 5 or Pi_Cam == 6) and focus_mode == 1:
-        rpistr += " --width 3280 --height 2464 -o /run/shm/test%d.jpg "
-    elif Pi_Cam == 7 :
-        rpistr += " --width 1456 --height 1088 -o /run/shm/test%d.jpg "
-    elif Pi_Cam == 3 :
-        rpistr += " --width 2304 --height 1296 -o /run/shm/test%d.jpg "
-    elif (Pi_Cam == 5 or Pi_Cam == 6) or focus_mode == 1 :
-        rpistr += " --width 1920 --height 1440 -o /run/shm/test%d.jpg "
+# CAPTURE BUTTONS
+# shared by the video, pre-record and stream captures
+def capture_buttons(msg0,msg1):
+    # CAPTURE Video shows msg0 / msg1, the other CAPTURE buttons are greyed out
+    button(1,0,1,3)
+    text(1,0,3,0,1,msg0,ft,0)
+    text(1,0,3,1,1,msg1,ft,0)
+    text(0,0,0,0,1,"CAPTURE",ft,7)
+    if Pi_Cam == 6 and mode == 0:
+        text(0,0,0,1,1,"STILL    2x2",ft,7)
     else:
-        if preview_width == 600 and preview_height == 480:
-            rpistr += " --width 720 --height 540 -o /run/shm/test%d.jpg "
-        else:
-            rpistr += " --width 1920 --height 1440 -o /run/shm/test%d.jpg "
-    rpistr += " --brightness " + str(brightness/100) + " --contrast " + str(contrast/100)
-    if mode == 0:
-        rpistr += " --shutter " + str(speed2) 
+        text(0,0,0,1,1,"Still ",ft,7)
+    text(1,9,0,0,1,"CAPTURE",ft,7)
+    if Pi_Cam == 6 and mode == 0 and tinterval > 0:
+        text(1,9,0,1,1,"T'lapse  2x2",ft,7)
     else:
-        rpistr += " --exposure " + str(modes[mode]) 
-    if zoom > 4 and (Pi_Cam < 5 or Pi_Cam == 7) and Pi_Cam != 3 and mode != 0:
-        rpistr += " --framerate " + str(focus_fps)
-    elif (zoom < 5 or Pi_Cam == 3) and mode != 0:
-        rpistr += " --framerate " + str(prev_fps)
-    elif mode == 0:
-        speed3 = 1000000/speed2
-        speed3 = min(speed3,25)
-        rpistr += " --framerate " + str(speed3)
-    if ev != 0:
-        rpistr += " --ev " + str(ev)
-    if sspeed > 5000000 and mode == 0:
-        rpistr += " --gain 1 --awbgains " + str(red/10) + "," + str(blue/10)
+        text(1,9,0,1,1,"Timelapse",ft,7)
+
+def capture_reset():
+    # back to the normal CAPTURE buttons and video length
+    td = timedelta(seconds=vlen)
+    if rotate != 0:
+        pygame.draw.rect(windowSurfaceObj,blackColor,Rect(0,0,preview_width,preview_height),0)
+    text(1,1,3,1,1,str(td),fv,11)
+    button(1,0,0,3)
+    text(0,0,1,0,1,"CAPTURE",ft,7)
+    if Pi_Cam == 6 and mode == 0:
+        text(0,0,1,1,1,"STILL    2x2",ft,7)
     else:
-        rpistr += " --gain " + str(gain)
-        if awb == 0:
-            rpistr += " --awbgains " + str(red/10) + "," + str(blue/10)
+        text(0,0,1,1,1,"Still ",ft,7)
+    text(1,0,1,0,1,"CAPTURE",ft,7)
+    text(1,0,1,1,1,"Video",ft,7)
+    text(1,9,1,0,1,"CAPTURE",ft,7)
+    if Pi_Cam == 6 and mode == 0 and tinterval > 0:
+        text(1,9,1,1,1,"T'lapse  2x2",ft,7)
+    else:
+        text(1,9,1,1,1,"Timelapse",ft,7)
+
+def click_button(pos):
+    # button column and row clicked while capturing, (0,0) if not on a button
+    mousex, mousey = pos
+    if mousex > preview_width:
+        return int((mousex-preview_width)/bw) + 1,int((mousey)/bh) + 1
+    if mousey - preview_height < 0:
+        return 0,0
+    if mousey - preview_height < bh:
+        return 1,int(mousex / bw) + 1
+    if mousey - preview_height < bh * 2:
+        return 1,int(mousex / bw) + 7
+    if mousey - preview_height < bh * 3:
+        return 2,int(mousex / bw) + 1
+    if mousey - preview_height < bh * 4:
+        return 2,int(mousex / bw) + 8
+    return 0,0
+
+# HISTOGRAM GRAPH
+# 256 levels x 100 high, drawn into a cached surface from numpy masks
+hist_out  = np.zeros((256,100,3),np.uint8)
+hist_y    = np.arange(100)
+hist_surf = None
+
+def hist_levels(chan):
+    # log scaled count of each level
+    counts = np.bincount(chan.ravel(),minlength=256)
+    return (25 * np.log10(np.maximum(counts,1))).astype(np.int32)
+
+def hist_mask(levels):
+    # vertical line from the previous level to this one, levels of 0 are not drawn
+    old = np.concatenate(([0],levels[:-1]))
+    lo  = np.where(levels > old,old,levels + 1)
+    hi  = np.where(levels > old,levels - 1,old)
+    hi[levels == 0] = -1
+    hi[255] = -1
+    return (hist_y >= lo[:,None]) & (hist_y <= hi[:,None])
+
+def hist_graph(crop2,gray):
+    global hist_surf
+    hist_out[:] = 0
+    if histogram == 4 or histogram == 5:
+        hist_out[hist_mask(hist_levels(gray))] = 255
+    if histogram == 1 or histogram == 5:
+        hist_out[:,:,0][hist_mask(hist_levels(crop2[:,:,0]))] = 255
+    if histogram == 2 or histogram == 5:
+        hist_out[:,:,1][hist_mask(hist_levels(crop2[:,:,1]))] = 255
+    if histogram == 3 or histogram == 5:
+        hist_out[:,:,2][hist_mask(hist_levels(crop2[:,:,2]))] = 255
+    if hist_surf == None:
+        hist_surf = pygame.Surface((256,100),0,24)
+        hist_surf.set_alpha(160)
+    pygame.surfarray.blit_array(hist_surf,hist_out[:,::-1])
+    return hist_surf
+
+# FOCUS PEAKING
+# laplacian of the whole displayed frame, thresholded at peak_level, and copied as peak_color into a cached
+# surface with black as its colorkey. All the buffers are kept until the preview size changes
+peak_gray = None
+peak_lap  = None
+peak_abs  = None
+peak_mask = None
+peak_col  = None
+peak_rgb  = None
+peak_surf = None
+
+def peak_overlay(image):
+    global peak_gray,peak_lap,peak_abs,peak_mask,peak_col,peak_rgb,peak_surf
+    w,h = image.get_size()
+    if peak_surf == None or peak_surf.get_size() != (w,h):
+        peak_gray = np.empty((h,w),np.uint8)
+        peak_lap  = np.empty((h,w),np.int16)
+        peak_abs  = np.empty((h,w),np.uint8)
+        peak_mask = np.empty((h,w),np.uint8)
+        peak_col  = np.empty((h,w,3),np.uint8)
+        peak_col[:] = peak_color
+        peak_rgb  = np.zeros((h,w,3),np.uint8)
+        peak_surf = pygame.image.frombuffer(peak_rgb,(w,h),'RGB')
+        peak_surf.set_colorkey((0,0,0))
+    rgb = pygame.surfarray.pixels3d(image).transpose(1,0,2)
+    cv2.cvtColor(rgb,cv2.COLOR_RGB2GRAY,dst=peak_gray)
+    del rgb
+    cv2.Laplacian(peak_gray,cv2.CV_16S,dst=peak_lap)
+    cv2.convertScaleAbs(peak_lap,dst=peak_abs)
+    cv2.threshold(peak_abs,peak_level,255,cv2.THRESH_BINARY,dst=peak_mask)
+    peak_rgb[:] = 0
+    cv2.copyTo(peak_col,peak_mask,peak_rgb)
+    return peak_surf
+
+# EXPOSURE
+# the numbers come from every zebra_step'th pixel of the displayed frame. The stripes are a fixed diagonal
+# pattern masked by the highlights and copied as black into a cached surface with magenta as its colorkey
+zebra_step   = 4
+zebra_key    = (255,0,255)
+zebra_luma   = None
+zebra_high   = None
+zebra_stripe = None
+zebra_black  = None
+zebra_rgb    = None
+zebra_surf   = None
+
+def exp_frame(image):
+    # returns the zebra surface and the exposure numbers for a displayed frame
+    global zebra_luma,zebra_high,zebra_stripe,zebra_black,zebra_rgb,zebra_surf
+    w,h = image.get_size()
+    if zebra_surf == None or zebra_surf.get_size() != (w,h):
+        zebra_luma   = np.empty((h,w),np.uint8)
+        zebra_high   = np.empty((h,w),np.uint8)
+        zebra_stripe = np.where(((np.arange(h)[:,None] + np.arange(w)) % 8) < 4,255,0).astype(np.uint8)
+        zebra_black  = np.zeros((h,w,3),np.uint8)
+        zebra_rgb    = np.empty((h,w,3),np.uint8)
+        zebra_surf   = pygame.image.frombuffer(zebra_rgb,(w,h),'RGB')
+        zebra_surf.set_colorkey(zebra_key)
+    rgb = pygame.surfarray.pixels3d(image).transpose(1,0,2)
+    cv2.cvtColor(rgb,cv2.COLOR_RGB2GRAY,dst=zebra_luma)
+    means = rgb[::zebra_step,::zebra_step].mean(axis=(0,1))
+    del rgb
+    luma  = zebra_luma[::zebra_step,::zebra_step]
+    high  = np.count_nonzero(luma >= zebra_level) * 100/luma.size
+    low   = np.count_nonzero(luma <= shadow_level) * 100/luma.size
+    cv2.threshold(zebra_luma,zebra_level - 1,255,cv2.THRESH_BINARY,dst=zebra_high)
+    cv2.bitwise_and(zebra_high,zebra_stripe,dst=zebra_high)
+    zebra_rgb[:] = zebra_key
+    cv2.copyTo(zebra_black,zebra_high,zebra_rgb)
+    msg = ("Y " + str(int(luma.mean())) + "  R " + str(int(means[0])) + " G " + str(int(means[1])) + " B " + str(int(means[2]))
+           + "  clip " + str(round(high,1)) + "%  dark " + str(round(low,1)) + "%")
+    return zebra_surf,msg
+
+# PREVIEW SETTINGS
+# the preview command line is the settings model, restarts are skipped when nothing in it has changed
+prev_opts = {}
+mouse_up  = 0
+
+def cmd_opts(cmd):
+    # split a libcamera command into {option:value}
+    opts = {}
+    key = ""
+    for arg in cmd[1:]:
+        if arg[:2] == "--":
+            key = arg[2:]
+            opts[key] = ""
+        elif opts.get(key,"") == "":
+            opts[key] = arg
         else:
-            rpistr += " --awb " + awbs[awb]
-    rpistr += " --metering "   + meters[meter]
-    rpistr += " --saturation " + str(saturation/10)
-    rpistr += " --sharpness "  + str(sharpness/10)
-    rpistr += " --denoise "    + denoises[denoise]
-    rpistr += " --quality " + str(quality)
-    if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0:
-        rpistr += " --autofocus "
-    if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
-        rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode]
-        if v3_f_mode == 1:
-            rpistr += " --lens-position " + str(v3_focus/100)
-    elif Pi_Cam == 3 and zoom == 0 and fxx != 0 and v3_f_mode != 1:
-        rpistr += " --autofocus-window " + str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)
-    if Pi_Cam == 3 and v3_f_speed != 0:
-        rpistr += " --autofocus-speed " + v3_f_speeds[v3_f_speed]
-    if Pi_Cam == 3 and v3_f_range != 0:
-        rpistr += " --autofocus-range " + v3_f_ranges[v3_f_range]
-    if Pi_Cam == 3 and v3_hdr == 1:
-        rpistr += " --hdr"
-    if Pi_Cam == 4 and scientific == 1:
-        rpistr += " --tuning-file /usr/share/libcamera/ipa/rpi/vc4/imx477_scientific.json"
-    if zoom > 1 and zoom < 5:
-        zxo = ((1920-zwidths[4 - zoom])/2)/1920
-        zyo = ((1440-zheights[4 - zoom])/2)/1440
-        rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(zwidths[4 - zoom]/1920) + "," + str(zheights[4 - zoom]/1440)
-    if zoom == 5:
-        zxo = ((igw/2)-(preview_width/2))/igw
-        zyo = ((igh/2)-(preview_height/2))/igh
-        rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)
-    p = subprocess.Popen(rpistr, shell=True, preexec_fn=os.setsid)
+            opts[key] += " " + arg
+    return opts
+
+def preview_diff():
+    # names of the settings that differ from the running preview
+    opts = cmd_opts(camera_cmd('preview'))
+    return [k for k in set(opts) | set(prev_opts) if opts.get(k) != prev_opts.get(k)]
+
+def preview_stop():
+    # stop libcamera-vid and wait for it to release the camera
+    poll = p.poll()
+    if poll == None:
+        os.killpg(p.pid, signal.SIGTERM)
+        try:
+            p.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            os.killpg(p.pid, signal.SIGKILL)
+            p.wait()
+
+def preview():
+    global yuv_w,yuv_h,restart,rpistr,p,prev_opts
+    if prev_pipe == 0:
+        files = glob.glob('/run/shm/*.jpg')
+        for f in files:
+            os.remove(f)
+    with frame_cond:
+        frames.clear()
+    if prev_pipe == 2:
+        yuv_w,yuv_h = prev_size(igw,igh,Pi_Cam,rotate)
+    rpistr = camera_cmd('preview')
+    prev_opts = cmd_opts(rpistr)
+    if prev_pipe == 0:
+        p = subprocess.Popen(rpistr, preexec_fn=os.setsid)
+    else:
+        p = subprocess.Popen(rpistr, preexec_fn=os.setsid, stdout=subprocess.PIPE)
+        if prev_pipe == 2:
+            threading.Thread(target=yuv_reader, args=(p.stdout,int(yuv_w * yuv_h * 3/2)), daemon=True).start()
+        else:
+            threading.Thread(target=frame_reader, args=(p.stdout,), daemon=True).start()
     #print (rpistr)
     restart = 0
+    display_flush()
     time.sleep(0.2)
     if Pi_Cam == 3 and rotate == 0:
         pygame.draw.rect(windowSurfaceObj,(0,0,0),Rect(0,int(preview_height * .75),preview_width,int(preview_height *.24) ))
@@ -631,6 +2107,7 @@ def v3_focus_manual():
     draw_Vbar(1,7,dgryColor,'v3_focus',v3_focus-v3_pmin)
     text(1,7,3,0,1,'<<< ' + str(int(v3_focus)) + ' >>>',fv,0)
     text(1,7,3,1,1,str(v3_f_modes[v3_f_mode]),fv,0)
+    display_flush()
     time.sleep(0.25)
         
 # draw buttons
@@ -824,6 +2301,7 @@ while max_shutter > shutters[max_speed]:
     max_speed +=1
     
 text(0,0,6,2,1,"Found " + str(cameras[Pi_Cam]),int(fv*1.7),1)
+display_flush()
 time.sleep(1)
     
 # set maximum speed, based on camera version
@@ -856,166 +2334,88 @@ fxy = 0
 fxz = 1
 fyz = 1
 old_histarea = histarea
+prev_seq = 0
 
 # start preview
 if rotate == 0:
     text(0,0,6,2,1,"Please Wait for preview...",int(fv*1.7),1)
+if prev_pipe > 0:
+    for t in range(0,prev_threads):
+        threading.Thread(target=frame_decoder, daemon=True).start()
 preview()
+if web_port > 0:
+    threading.Thread(target=web_serve, daemon=True).start()
+
+buttonx    = (0,0,0)
+mouse_next = 0   # held mouse buttons repeat from this time
+mouse_wait = 0
 
 # main loop
 while True:
-    time.sleep(0.1)
-    # focus UP
-    if Pi_Cam == 3:
-      if buttonFUP.is_pressed:
-        if v3_f_mode != 1:
-            v3_focus_manual()
-        v3_focus += 1
-        v3_focus = min(v3_focus,v3_pmax)
-        draw_Vbar(1,7,dgryColor,'focus',v3_focus * 4)
-        os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(v3_focus))
-        text(1,7,3,0,1,'<<< ' + str(v3_focus) + ' >>>',fv,0)
-        time.sleep(0.25)
+    display_flush()
+    # wait for a preview frame, mouse, GPIO or capture event. Only poll while jpgs are read
+    # from /run/shm, a mouse button is held or a restart is waiting for prev_wait
+    if prev_pipe == 0 or buttonx[0] != 0 or restart > 0:
+        event = pygame.event.wait(100)
+    else:
+        event = pygame.event.wait(1000)
+    events = pygame.event.get()
+    if event.type != NOEVENT:
+        events.insert(0,event)
+    # time of the last mouse release, for the RESTART hold below
+    for event in events:
+        if event.type == MOUSEBUTTONUP:
+            mouse_up = time.monotonic()
 
-    # focus DOWN
-    if Pi_Cam == 3:
-      if buttonFDN.is_pressed:
+    # focus UP / DOWN
+    for event in events:
+      if event.type == FOCUSSTEP and Pi_Cam == 3:
         if v3_f_mode != 1:
             v3_focus_manual()
-        v3_focus -= 1
-        v3_focus = max(v3_focus,v3_pmin)
+        v3_focus += event.step
+        v3_focus = max(min(v3_focus,v3_pmax),v3_pmin)
         draw_Vbar(1,7,dgryColor,'focus',v3_focus * 4)
-        os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(v3_focus))
+        focus_set(v3_focus)
         text(1,7,3,0,1,'<<< ' + str(v3_focus) + ' >>>',fv,0)
-        time.sleep(0.25)
         
-    pics = glob.glob('/run/shm/*.jpg')
-    if len(pics) > 1:
-        try:
-            image = pygame.image.load(pics[1])
-            for tt in range(1,len(pics)):
-                 os.remove(pics[tt])
-        except pygame.error:
-            pass
-        if Pi_Cam == 3 and zoom < 5:
-            if rotate == 0:
-                image = pygame.transform.scale(image, (preview_width,int(preview_height * 0.75)))
-            else:
-                image = pygame.transform.rotate(image, int(rotate * 90))
-                if rotate != 2:
-                    igwr = image.get_width()
-                    ighr = image.get_height()
-                    image = pygame.transform.scale(image, (int(preview_height * (igwr/ighr)),preview_height))
-                else:
-                    image = pygame.transform.scale(image, (preview_width,preview_height))
-        else:
-            if rotate == 0:
-                image = pygame.transform.scale(image, (preview_width,preview_height))
-            else:
-                image = pygame.transform.rotate(image, int(rotate * 90))
-                if rotate != 2:
-                    igwr = image.get_width()
-                    ighr = image.get_height()
-                    image = pygame.transform.scale(image, (int(preview_height * (igwr/ighr)),preview_height))
-                else:
-                    image = pygame.transform.scale(image, (preview_width,preview_height))
+    image = None
+    luma  = None
+    if prev_pipe == 0:
+        pics = glob.glob('/run/shm/*.jpg')
+        if len(pics) > 1:
+            with open(pics[1],'rb') as f:
+                data = f.read()
+            frame_put(data,0)
+            img = frame_decode(data)
+            if img is not None:
+                image = frame_surface(img)
+                for tt in range(1,len(pics)):
+                     os.remove(pics[tt])
+    else:
+        frm = frame_get(prev_seq)
+        if frm != None:
+            prev_seq,image,luma = frm
+    if image != None:
         if rotate == 1 or rotate == 3:
-            windowSurfaceObj.blit(image, (int((preview_width/2) - ((preview_height * (igwr/ighr)))/2),0))
+            ix = int((preview_width - image.get_width())/2)
         else:
-            windowSurfaceObj.blit(image, (0,0))
+            ix = 0
+        windowSurfaceObj.blit(image, (ix,0))
+        if peaking == 1:
+            windowSurfaceObj.blit(peak_overlay(image), (ix,0))
+        if zebra == 1:
+            zsurf,zmsg = exp_frame(image)
+            windowSurfaceObj.blit(zsurf, (ix,0))
+            text(0,int(preview_height/int(fv*1.5)) - 1,6,2,0,zmsg,int(fv*1.5),0)
         if zoom > 0 or foc_man == 1:
             image2 = pygame.surfarray.pixels3d(image)
             crop2 = image2[xx-histarea:xx+histarea,xy-histarea:xy+histarea]
-            gray = cv2.cvtColor(crop2,cv2.COLOR_RGB2GRAY)
+            if luma is not None:
+                gray = luma[xy-histarea:xy+histarea,xx-histarea:xx+histarea]
+            else:
+                gray = cv2.cvtColor(crop2,cv2.COLOR_RGB2GRAY)
             if zoom > 0 and histogram > 0:
-                if (histogram == 1 or histogram == 5):
-                    red1   = crop2[:,:,0]
-                    red2   = red1.reshape(histarea * histarea * 4,1)
-                    rede   = [0] * 256
-                if (histogram == 2 or histogram == 5):
-                    green1 = crop2[:,:,1]
-                    green2 = green1.reshape(histarea * histarea * 4,1)
-                    greene = [0] * 256
-                if (histogram == 3 or histogram == 5):
-                    blue1  = crop2[:,:,2]
-                    blue2  = blue1.reshape(histarea * histarea * 4,1)
-                    bluee  = [0] * 256
-
-                gray2  = gray.reshape(histarea * histarea * 4,1)
-                lume   = [0] * 256
-                for q in range(0,len(gray2)):
-                    if (histogram == 4 or histogram == 5):
-                        lume[int(gray2[q])] +=1
-                    if (histogram == 1 or histogram == 5):
-                        rede[int(red2[q])] +=1
-                    if (histogram == 2 or histogram == 5):
-                        greene[int(green2[q])] +=1
-                    if (histogram == 3 or histogram == 5):
-                        bluee[int(blue2[q])] +=1
-                for t in range(0,256):
-                    if histogram == 4 or histogram == 5:
-                        if lume[t] > 0:
-                            lume[t] = int(25*math.log10(lume[t]))
-                    if histogram == 1 or histogram == 5:
-                        if rede[t] > 0:
-                            rede[t] = int(25*math.log10(rede[t]))
-                    if histogram == 2 or histogram == 5:
-                        if greene[t] > 0:
-                            greene[t] = int(25*math.log10(greene[t]))
-                    if histogram == 3 or histogram == 5:
-                        if bluee[t] > 0:
-                            bluee[t] = int(25*math.log10(bluee[t]))
-                output = np.zeros((256,100,3))
-                old_lume   = 0
-                old_rede   = 0
-                old_greene = 0
-                old_bluee  = 0
-                for count in range(0,255):
-                    if histogram == 4 or histogram == 5:
-                      if lume[count] > 0:
-                        if lume[count] > old_lume:
-                            st = 1
-                        else:
-                            st = -1
-                        for y in range(old_lume,lume[count],st):
-                            output[count, y,0] = 255
-                            output[count, y,1] = 255
-                            output[count, y,2] = 255
-                    if histogram == 1 or histogram == 5:
-                      if rede[count] > 0:
-                        if rede[count] > old_rede:
-                            st = 1
-                        else:
-                            st = -1
-                        for y in range(old_rede,rede[count],st):
-                            output[count, y,0] = 255
-                    if histogram == 2 or histogram == 5:
-                      if greene[count] > 0:
-                        if greene[count] > old_greene:
-                            st = 1
-                        else:
-                            st = -1
-                        for y in range(old_greene,greene[count],st):
-                            output[count, y,1] = 255
-                    if histogram == 3 or histogram == 5:
-                      if bluee[count] > 0:
-                        if bluee[count] > old_bluee:
-                            st = 1
-                        else:
-                            st = -1
-                        for y in range(old_bluee,bluee[count],st):
-                            output[count, y,2] = 255
-                    if histogram == 4 or histogram == 5:
-                        old_lume   = lume[count]
-                    if histogram == 1 or histogram == 5:
-                        old_rede   = rede[count]
-                    if histogram == 2 or histogram == 5:
-                        old_greene = greene[count]
-                    if histogram == 3 or histogram == 5:
-                        old_bluee  = bluee[count]
-                graph = pygame.surfarray.make_surface(output)
-                graph = pygame.transform.flip(graph,0,1)
-                graph.set_alpha(160)
+                graph = hist_graph(crop2,gray)
                 pygame.draw.rect(windowSurfaceObj,greyColor,Rect(9,preview_height-111,64,102),1)
                 pygame.draw.rect(windowSurfaceObj,greyColor,Rect(73,preview_height-111,64,102),1)
                 pygame.draw.rect(windowSurfaceObj,greyColor,Rect(137,preview_height-111,64,102),1)
@@ -1023,7 +2423,7 @@ while True:
                 windowSurfaceObj.blit(graph, (10,preview_height-110))
             if rotate != 0:
                 pygame.draw.rect(windowSurfaceObj,blackColor,Rect(0,0,int(preview_width/4.5),int(preview_height/8)),0)
-            foc = cv2.Laplacian(gray, cv2.CV_64F).var()
+            foc = focus_value(gray,focus_metric)
             text(20,0,3,2,0,"Focus: " + str(int(foc)),fv* 2,0)
             pygame.draw.rect(windowSurfaceObj,redColor,Rect(xx-histarea,xy-histarea,histarea*2,histarea*2),1)
             pygame.draw.line(windowSurfaceObj,(255,255,255),(xx-int(histarea/2),xy),(xx+int(histarea/2),xy),1)
@@ -1097,11 +2497,16 @@ while True:
                     pygame.draw.rect(windowSurfaceObj,(155,0,150),Rect(int(preview_height * 0.51),int(preview_width * 0.15),int(preview_height * 0.33),int(preview_width * 0.45)),gw)
                 elif Pi_Cam == 2 and ((vwidth == 640 and vheight == 480) or (vwidth == 720 and vheight == 540)):
                     pygame.draw.rect(windowSurfaceObj,(155,0,150),Rect(int(preview_height * 0.50),int(preview_width * 0.22),int(preview_height * 0.33),int(preview_width * 0.31)),gw)
-        pygame.display.update()
+        dirty.append(Rect(0,0,preview_width,preview_height))
     
     # continuously read mouse buttons
     buttonx = pygame.mouse.get_pressed()
-    if buttonx[0] != 0 :
+    for event in events:
+        # a click released before the events were read still counts
+        if event.type == MOUSEBUTTONDOWN and event.button == 1:
+            buttonx = (1,0,0)
+    if buttonx[0] != 0 and time.monotonic() >= mouse_next:
+        mouse_wait = 0
         pos = pygame.mouse.get_pos()
         mousex = pos[0]
         mousey = pos[1]
@@ -1221,7 +2626,7 @@ while True:
                         text(0,2,3,1,1,str(shutters[speed]),fv,10)
                     draw_bar(0,2,lgrnColor,'speed',speed)
 
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
 
             elif button_row == 3:
@@ -1264,7 +2669,7 @@ while True:
                         text(1,10,3,1,1,str(td),fv,12)
                         draw_Vbar(1,10,lyelColor,'tduration',tduration)
                         
-                    time.sleep(.25)
+                    mouse_wait = .25
                     restart = 1
                 else:
                     # EV
@@ -1285,7 +2690,7 @@ while True:
                             ev = min(ev ,pmax)
                     text(0,2,3,1,1,str(ev),fv,10)
                     draw_bar(0,2,lgrnColor,'ev',ev)
-                    time.sleep(0.25)
+                    mouse_wait = 0.25
                     restart = 1
                     
             elif button_row == 4:
@@ -1317,7 +2722,7 @@ while True:
                     else:
                         text(0,3,5,0,1,"Gain    A/D",ft,10)
                     text(0,3,3,1,1,"Auto",fv,10)
-                time.sleep(.25)
+                mouse_wait = .25
                 draw_bar(0,3,lgrnColor,'gain',gain)
                 restart = 1
                 
@@ -1340,7 +2745,7 @@ while True:
                         brightness = min(brightness ,pmax)
                 text(0,4,3,1,1,str(brightness/100),fv,10)
                 draw_bar(0,4,lgrnColor,'brightness',brightness)
-                time.sleep(0.025)
+                mouse_wait = 0.025
                 restart = 1
                 
             elif button_row == 6:
@@ -1362,7 +2767,7 @@ while True:
                         contrast = min(contrast ,pmax)
                 text(0,5,3,1,1,str(contrast/100)[0:4],fv,10)
                 draw_bar(0,5,lgrnColor,'contrast',contrast)
-                time.sleep(0.025)
+                mouse_wait = 0.025
                 restart = 1
                 
                 
@@ -1385,7 +2790,7 @@ while True:
                         blue = min(blue ,pmax)
                 text(0,7,3,1,1,str(blue/10)[0:3],fv,10)
                 draw_bar(0,7,lgrnColor,'blue',blue)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
 
             elif button_row == 11:
@@ -1407,7 +2812,7 @@ while True:
                         quality = min(quality ,pmax)
                 text(0,10,3,1,1,str(quality)[0:3],fv,10)
                 draw_bar(0,10,lgrnColor,'quality',quality)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
 
             elif button_row == 9 and awb == 0 :
@@ -1429,7 +2834,7 @@ while True:
                         red = min(red ,pmax)
                 text(0,8,3,1,1,str(red/10)[0:3],fv,10)
                 draw_bar(0,8,lgrnColor,'red',red)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
 
             elif button_row == 8 and awb != 0:
@@ -1451,7 +2856,7 @@ while True:
                         denoise = min(denoise,pmax)
                 text(0,7,3,1,1,denoises[denoise],fv,10)
                 draw_bar(0,7,lgrnColor,'denoise',denoise)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
 
             elif button_row == 9 and awb != 0:
@@ -1474,7 +2879,7 @@ while True:
                         
                 text(0,8,3,1,1,str(sharpness/10),fv,10)
                 draw_bar(0,8,lgrnColor,'sharpness',sharpness)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
                 
             elif button_row == 10:
@@ -1496,7 +2901,7 @@ while True:
                         extn = min(extn ,pmax) 
                 text(0,9,3,1,1,extns[extn],fv,10)
                 draw_bar(0,9,lgrnColor,'extn',extn)
-                time.sleep(.25)
+                mouse_wait = .25
                 
             elif button_row == 7:
                 # AWB
@@ -1531,7 +2936,7 @@ while True:
                     text(0,8,3,1,1,str(sharpness/10),fv,10)
                     draw_bar(0,7,lgrnColor,'denoise',denoise)
                     draw_bar(0,8,lgrnColor,'sharpness',sharpness)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
                 
             elif button_row == 12:
@@ -1553,7 +2958,7 @@ while True:
                         saturation = min(saturation ,pmax)
                 text(0,11,3,1,1,str(saturation/10),fv,10)
                 draw_bar(0,11,lgrnColor,'saturation',saturation)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
                 
             elif button_row == 13:
@@ -1575,7 +2980,7 @@ while True:
                         meter = min(meter ,pmax)
                 text(0,12,3,1,1,meters[meter],fv,10)
                 draw_bar(0,12,lgrnColor,'meter',meter)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
 
             elif button_row == 14 and Pi_Cam == 3:
@@ -1592,7 +2997,7 @@ while True:
                     text(0,13,3,1,1,"Off",fv,10)
                 else:
                     text(0,13,3,1,1,"ON ",fv,10)
-                time.sleep(0.25)
+                mouse_wait = 0.25
                 restart = 1
 
             elif button_row == 14 and Pi_Cam == 4 and scientif == 1:
@@ -1609,7 +3014,7 @@ while True:
                     text(0,13,3,1,1,"Off",fv,10)
                 else:
                     text(0,13,3,1,1,"ON ",fv,10)
-                time.sleep(0.25)
+                mouse_wait = 0.25
                 restart = 1
 
             elif button_row == 15:
@@ -1631,7 +3036,7 @@ while True:
                         histogram = min(histogram,pmax)
                 text(0,14,3,1,1,histograms[histogram],fv,7)
                 draw_bar(0,14,greyColor,'histogram',histogram)
-                time.sleep(.25)
+                mouse_wait = .25
 
             elif button_row == 16 and Pi_Cam == 3:
                 # V3 FOCUS SPEED 
@@ -1653,7 +3058,7 @@ while True:
                 text(0,15,3,1,1,v3_f_speeds[v3_f_speed],fv,7)
                 draw_bar(0,15,greyColor,'v3_f_speed',v3_f_speed)
                 restart = 1
-                time.sleep(.25)
+                mouse_wait = .25
                
           elif button_column == 2:
             if button_row == 2:
@@ -1676,7 +3081,7 @@ while True:
                 td = timedelta(seconds=vlen)
                 text(1,1,3,1,1,str(td),fv,11)
                 draw_Vbar(1,1,lpurColor,'vlen',vlen)
-                time.sleep(.25)
+                mouse_wait = .25
  
             elif button_row == 3:
                 # FPS
@@ -1702,7 +3107,7 @@ while True:
                 
                 text(1,2,3,1,1,str(fps),fv,11)
                 draw_Vbar(1,2,lpurColor,'fps',fps)
-                time.sleep(.25)
+                mouse_wait = .25
                 restart = 1
                    
             elif button_row == 4:
@@ -1824,7 +3229,7 @@ while True:
                 text(1,2,3,1,1,str(fps),fv,11)
                 draw_Vbar(1,2,lpurColor,'fps',fps)
                 text(1,3,3,1,1,str(vwidth) + "x" + str(vheight),fv,11)
-                time.sleep(.25)
+                mouse_wait = .25
 
             elif button_row == 5:
                 # CODEC
@@ -1890,7 +3295,7 @@ while True:
                 text(1,2,3,1,1,str(fps),fv,11)
                 draw_Vbar(1,2,lpurColor,'fps',fps)
                 text(1,3,3,1,1,str(vwidth) + "x" + str(vheight),fv,11)
-                time.sleep(.25)
+                mouse_wait = .25
 
             elif button_row == 6:
                 # H264 PROFILE
@@ -1935,7 +3340,7 @@ while True:
                 video_limits[5] = vfps
                 text(1,2,3,1,1,str(fps),fv,11)
                 draw_Vbar(1,2,lpurColor,'fps',fps)
-                time.sleep(.25)
+                mouse_wait = .25
 
             elif button_row == 7:
                 # V_PREVIEW
@@ -1974,7 +3379,7 @@ while True:
                 video_limits[5] = vfps
                 text(1,2,3,1,1,str(fps),fv,11)
                 draw_Vbar(1,2,lpurColor,'fps',fps)
-                time.sleep(0.25)
+                mouse_wait = 0.25
 
             elif button_row == 8:
                 # FOCUS
@@ -1991,7 +3396,7 @@ while True:
                 if (mousex > preview_width + bw and mousey < ((button_row-1)*bh) + (bh/3)) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     focus = int(((mousex-preview_width-bw) / bw) * pmax)
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                 elif mousex > preview_width + bw and mousey > ((button_row-1)*bh) + (bh/3) and mousey < ((button_row-1)*bh) + (bh/1.5) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     if button_pos == 2:
@@ -1999,13 +3404,13 @@ while True:
                     elif button_pos == 3:
                         focus += 10
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
 
                 elif (mousey > preview_height + (bh*3) and mousey < preview_height + (bh*3) + (bh/3)) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     focus = int(((mousex-((button_row - 8)*bw)) / bw)* pmax)
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                 elif mousey > preview_height + (bh*3) and mousey > preview_height + (bh*3) + (bh/3) and mousey < preview_height + (bh*3) + (bh/1.5) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     if button_pos == 0:
@@ -2013,7 +3418,7 @@ while True:
                     elif button_pos == 1:
                         focus += 10
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                 # new v3
                 elif (mousex > preview_width + bw and mousey < ((button_row-1)*bh) + (bh/3)) and Pi_Cam == 3 and foc_man == 1:
@@ -2057,7 +3462,7 @@ while True:
                         text(1,8,2,0,1,"ZOOMED",ft,0)
                         text(1,8,3,1,1,str(zoom),fv,0)
                         draw_Vbar(1,8,dgryColor,'zoom',zoom)
-                        time.sleep(0.25)
+                        mouse_wait = 0.25
                         restart = 1
                     elif (Pi_Cam < 3 or Pi_Cam == 4 or Pi_Cam == 7) and focus_mode == 1:
                         zoom = 0
@@ -2077,34 +3482,26 @@ while True:
                         foc_man = 1 
                         button(1,7,1,9)
                         restart = 1
-                        time.sleep(0.25)
+                        mouse_wait = 0.25
                         restart = 1 
                         draw_Vbar(1,7,dgryColor,'v3_focus',v3_focus-pmin)
                         text(1,7,3,0,1,'<<< ' + str(int(v3_focus)) + ' >>>',fv,0)
                         text(1,7,3,1,1,str(v3_f_modes[v3_f_mode]),fv,0)
-                        time.sleep(0.25)
+                        mouse_wait = 0.25
                     elif (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0:
                         focus_mode = 1
                         foc_man = 1 # manual focus
                         button(1,7,1,9)
-                        if os.path.exists("ctrls.txt"):
-                            os.remove("ctrls.txt")
-                        os.system("v4l2-ctl -d /dev/v4l-subdev1 --list-ctrls >> ctrls.txt")
                         restart = 1
-                        time.sleep(0.25)
-                        ctrlstxt = []
-                        with open("ctrls.txt", "r") as file:
-                            line = file.readline()
-                            while line:
-                                ctrlstxt.append(line.strip())
-                                line = file.readline()
-                        foc_ctrl = ctrlstxt[3].split('value=')
-                        focus = int(foc_ctrl[1])
-                        os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                        mouse_wait = 0.25
+                        foc_ctrl = focus_get()
+                        if foc_ctrl != None:
+                            focus = foc_ctrl
+                        focus_set(focus)
                         text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                         draw_Vbar(1,7,dgryColor,'focus',focus)
                         text(1,7,3,1,1,"manual",fv,0)
-                        time.sleep(0.25)
+                        mouse_wait = 0.25
                     elif (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                         focus_mode = 0
                         foc_man = 0
@@ -2116,7 +3513,7 @@ while True:
                         text(1,8,5,0,1,"Zoom",ft,7)
                         text(1,8,3,1,1,"",fv,7)
                         text(1,3,3,1,1,str(vwidth) + "x" + str(vheight),fv,11)
-                        time.sleep(0.25)
+                        mouse_wait = 0.25
                         restart = 1
                     elif Pi_Cam == 3 and v3_f_mode == 1:
                         focus_mode = 0
@@ -2135,7 +3532,7 @@ while True:
                         text(1,8,5,0,1,"Zoom",ft,7)
                         text(1,8,3,1,1,"",fv,7)
                         text(1,3,3,1,1,str(vwidth) + "x" + str(vheight),fv,11)
-                        time.sleep(0.25)
+                        mouse_wait = 0.25
                         restart = 1
                     elif Pi_Cam == 3 and v3_f_mode == 2:
                         focus_mode = 0
@@ -2154,9 +3551,9 @@ while True:
                         text(1,8,5,0,1,"Zoom",ft,7)
                         text(1,8,3,1,1,"",fv,7)
                         text(1,3,3,1,1,str(vwidth) + "x" + str(vheight),fv,11)
-                        time.sleep(0.25)
+                        mouse_wait = 0.25
                         restart = 1
-                time.sleep(.25)
+                mouse_wait = .25
                 
             elif button_row == 9:
                 # ZOOM
@@ -2199,7 +3596,7 @@ while True:
                     if Pi_Cam == 3 and v3_f_mode == 0:
                         text(1,7,3,1,1,str(v3_f_modes[v3_f_mode]),fv,7)
                 restart = 1
-                time.sleep(.2)
+                mouse_wait = .2
 
             elif button_row == 11:
                 # TIMELAPSE DURATION
@@ -2227,7 +3624,7 @@ while True:
                 else:
                     text(1,12,3,1,1," ",fv,12)
                 draw_Vbar(1,12,lyelColor,'tshots',tshots)
-                time.sleep(.25)
+                mouse_wait = .25
 
             elif button_row == 12:
                 # TIMELAPSE INTERVAL
@@ -2276,7 +3673,7 @@ while True:
                         restart = 1
                 else:
                     text(1,12,3,1,1,str(tshots),fv,12)
-                time.sleep(.25)
+                mouse_wait = .25
                 
             elif button_row == 13 and tinterval > 0:
                 # TIMELAPSE SHOTS
@@ -2304,7 +3701,7 @@ while True:
                 td = timedelta(seconds=tduration)
                 text(1,10,3,1,1,str(td),fv,12)
                 draw_Vbar(1,10,lyelColor,'tduration',tduration)
-                time.sleep(.25)
+                mouse_wait = .25
 
             elif button_row == 15:
                 # HISTOGRAM SIZE
@@ -2335,7 +3732,7 @@ while True:
                 text(1,14,3,1,1,str(histarea),fv,7)
                 draw_Vbar(1,14,greyColor,'histarea',histarea)
                 old_histarea = histarea
-                time.sleep(.25)
+                mouse_wait = .25
 
             elif button_row == 16 and Pi_Cam == 3:
                 # V3 FOCUS RANGE 
@@ -2357,7 +3754,7 @@ while True:
                 text(1,15,3,1,1,v3_f_ranges[v3_f_range],fv,7)
                 draw_Vbar(1,15,greyColor,'v3_f_range',v3_f_range)
                 restart = 1
-                time.sleep(.25)
+                mouse_wait = .25
 
                
             elif button_row == 14:
@@ -2399,24 +3796,67 @@ while True:
                    with open(config_file, 'w') as f:
                        for item in config:
                            f.write("%s\n" % item)
+                   display_flush()
                    time.sleep(1)
                    text(1,13,2,1,1,"Config",fv,7)
                 else:
-                   os.killpg(p.pid, signal.SIGTERM)
+                   poll = p.poll()
+                   if poll == None:
+                       os.killpg(p.pid, signal.SIGTERM)
+                   still_close()
                    pygame.display.quit()
                    sys.exit()
-    # RESTART         
-    if restart > 0 and buttonx[0] == 0:
-        os.killpg(p.pid, signal.SIGTERM)
-        time.sleep(0.25)
-        text(0,0,6,2,1,"Waiting for preview ...",int(fv*1.7),1)
-        preview()
+        mouse_next = time.monotonic() + mouse_wait
+    # RESTART, settings changes are held until prev_wait after the last mouse release
+    if restart > 0 and buttonx[0] == 0 and still_open == 0 and (restart > 1 or time.monotonic() - mouse_up > prev_wait):
+        poll = p.poll()
+        if restart == 1 and poll == None and len(preview_diff()) == 0:
+            restart = 0
+        else:
+            preview_stop()
+            text(0,0,6,2,1,"Waiting for preview ...",int(fv*1.7),1)
+            preview()
         
     #check for any mouse button presses
-    for event in pygame.event.get():
+    for event in events:
         if event.type == QUIT:
-            os.killpg(p.pid, signal.SIGTERM)
+            poll = p.poll()
+            if poll == None:
+                os.killpg(p.pid, signal.SIGTERM)
+            still_close()
             pygame.quit()
+        elif event.type == STILLDONE:
+            # still taken by the worker
+            still_busy -= 1
+            if event.image != None:
+                windowSurfaceObj.blit(event.image, (event.ix,0))
+            if len(event.meta) > 0:
+                text(0,25,6,2,1,"Ana Gain: " + str(event.meta.get("AnalogueGain",0)) + " Dig Gain: " + str(event.meta.get("DigitalGain",0)) + " Exp Time: " + str(event.meta.get("ExposureTime",0)) +"uS",int(fv*1.5),1)
+            text(0,0,6,2,1,event.fname,int(fv*1.5),1)
+            dirty.append(Rect(0,0,preview_width,preview_height))
+        elif event.type == STILLEND and still_busy == 0:
+            # camera released, back to the preview
+            still_open = 0
+            if rotate != 0:
+                pygame.draw.rect(windowSurfaceObj,blackColor,Rect(0,0,preview_width,preview_height),0)
+            button(0,0,0,4)
+            text(0,0,1,0,1,"CAPTURE",ft,7)
+            text(1,0,1,0,1,"CAPTURE",ft,7)
+            text(1,0,1,1,1,"Video",ft,7)
+            if Pi_Cam == 6 and mode == 0:
+                text(0,0,1,1,1,"STILL    2x2",ft,7)
+            else:
+                text(0,0,1,1,1,"Still ",ft,7)
+            text(1,9,1,0,1,"CAPTURE",ft,7)
+            if Pi_Cam == 6 and mode == 0 and tinterval > 0:
+                text(1,9,1,1,1,"T'lapse  2x2",ft,7)
+            else:
+                text(1,9,1,1,1,"Timelapse",ft,7)
+            restart = 2
+        elif event.type == KEYDOWN and event.key == K_p:
+            peaking = 1 - peaking
+        elif event.type == KEYDOWN and event.key == K_z:
+            zebra = 1 - zebra
         elif (event.type == MOUSEBUTTONUP):
             mousex, mousey = event.pos
             if mousex < preview_width and mousey < preview_height and rotate == 0 and event.button != 3:
@@ -2455,6 +3895,7 @@ while True:
                 poll = p.poll()
                 if poll == None:
                     os.killpg(p.pid, signal.SIGTERM)
+                focus_close()
                 Camera_Version()
                 restart = 1
                 
@@ -2502,10 +3943,10 @@ while True:
                 if button_column == 1:    
                     if button_row == 1 :
                         # TAKE STILL
-                        os.killpg(p.pid, signal.SIGTERM)
+                        poll = p.poll()
+                        if poll == None:
+                            os.killpg(p.pid, signal.SIGTERM)
                         button(0,0,1,4)
-                        if os.path.exists("PiLibtext.txt"):
-                             os.remove("PiLibtext.txt")
                         text(0,0,2,0,1,"CAPTURING",ft,0)
                         if Pi_Cam == 6 and mode == 0 and button_pos == 1:
                             text(0,0,2,1,1,"STILL    2x2",ft,0)
@@ -2521,421 +3962,194 @@ while True:
                         text(0,0,6,2,1,"Please Wait, taking still ...",int(fv*1.7),1)
                         now = datetime.datetime.now()
                         timestamp = now.strftime("%y%m%d%H%M%S")
-                        if extns[extn] != 'raw':
-                            fname =  pic_dir + str(timestamp) + '.' + extns2[extn]
-                            rpistr = "libcamera-still --camera " + str(camera) + " -e " + extns[extn] + " -n -t 5000 -o " + fname
+                        # stills queued within the same second get a suffix
+                        if timestamp == still_last:
+                            still_sub += 1
                         else:
-                            fname =  pic_dir + str(timestamp) + '.' + extns2[extn]
-                            rpistr = "libcamera-still --camera " + str(camera) + " -r -n -t 5000 -o " + fname
-                            if preview_width == 640 and preview_height == 480 and zoom == 4:
-                                rpistr += " --rawfull"
-                        rpistr += " --brightness " + str(brightness/100) + " --contrast " + str(contrast/100)
-                        if extns[extn] == "jpg" and preview_width == 640 and preview_height == 480 and zoom == 4:
-                            rpistr += " -r --rawfull"
-                        if mode == 0:
-                            rpistr += " --shutter " + str(sspeed)
+                            still_sub = 0
+                        still_last = timestamp
+                        if still_sub > 0:
+                            timestamp += "_" + str(still_sub)
+                        fname =  pic_dir + str(timestamp) + '.' + extns2[extn]
+                        if mode == 0 and button_pos == 1:
+                            rpistr = camera_cmd('still',1)
                         else:
-                            rpistr += " --exposure " + str(modes[mode])
-                        if ev != 0:
-                            rpistr += " --ev " + str(ev)
-                        if sspeed > 1000000 and mode == 0 and (Pi_Cam < 5 or Pi_Cam == 7):
-                            rpistr += " --gain " + str(gain) + " --immediate --awbgains " + str(red/10) + "," + str(blue/10)
-                        else:    
-                            rpistr += " --gain " + str(gain)
-                            if awb == 0:
-                                rpistr += " --awbgains " + str(red/10) + "," + str(blue/10)
-                            else:
-                                rpistr += " --awb " + awbs[awb]
-                        rpistr += " --metering " + meters[meter]
-                        rpistr += " --saturation " + str(saturation/10)
-                        rpistr += " --sharpness " + str(sharpness/10)
-                        rpistr += " --quality " + str(quality)
-                        rpistr += " --denoise " + denoises[denoise] # + " --width 2304 --height 1296"
-                        if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0:
-                            rpistr += " --autofocus "
-                        if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
-                            rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode]
-                            if v3_f_mode == 1:
-                                rpistr += " --lens-position " + str(v3_focus/100)
-                        elif Pi_Cam == 3 and v3_f_mode == 0 and fxz == 1:
-                            rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode] + " --autofocus-on-capture"
-                        elif Pi_Cam == 3 and zoom == 0:
-                            rpistr += " --autofocus-window " + str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)
-                        if  v3_hdr == 1:
-                            rpistr += " --hdr"
-                        if Pi_Cam == 6 and mode == 0 and button_pos == 1:
-                            rpistr += " --width 4624 --height 3472 " # 16MP superpixel mode for higher light sensitivity
-                        elif Pi_Cam == 6:
-                            rpistr += " --width 9152 --height 6944"
-                        if zoom > 0 and zoom < 5:
-                            zxo = ((igw-zws[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igw
-                            zyo = ((igh-zhs[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igh
-                            rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(zws[(4-zoom) + ((Pi_Cam-1)* 4)]/igw) + "," + str(zhs[(4-zoom) + ((Pi_Cam-1)* 4)]/igh)
-                        if zoom == 5:
-                            zxo = ((igw/2)-(preview_width/2))/igw
-                            zyo = ((igh/2)-(preview_height/2))/igh
-                            rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)
-                        rpistr += " --metadata - --metadata-format txt >> PiLibtext.txt"
+                            rpistr = camera_cmd('still')
                         #print(rpistr)
-                        os.system(rpistr)
-
-                        while not os.path.exists(fname):
-                            pass
-                        if extns2[extn] == 'jpg' or extns2[extn] == 'bmp' or extns2[extn] == 'png':
-                            image = pygame.image.load(fname)
-                            if rotate != 0:
-                                image = pygame.transform.rotate(image, int(rotate * 90))
-                                pygame.image.save(image,fname[:-4]+"r." + extns2[extn])
-                            if Pi_Cam == 3 and zoom < 5:
-                                if rotate == 0:
-                                    image = pygame.transform.scale(image, (preview_width,int(preview_height * 0.75)))
-                                else:
-                                    #image = pygame.transform.rotate(image, int(rotate * 90))
-                                    if rotate != 2:
-                                        igwr = image.get_width()
-                                        ighr = image.get_height()
-                                        image = pygame.transform.scale(image, (int(preview_height * (igwr/ighr)),preview_height))
-                                    else:
-                                        image = pygame.transform.scale(image, (preview_width,preview_height))
-                            else:
-                                if rotate == 0 or rotate == 2:
-                                    image = pygame.transform.scale(image, (preview_width,preview_height))
-                                else:
-                                    if rotate != 2:
-                                        igwr = image.get_width()
-                                        ighr = image.get_height()
-                                        image = pygame.transform.scale(image, (int(preview_height * (igwr/ighr)),preview_height))
-                                    else:
-                                        image = pygame.transform.scale(image, (preview_width,preview_height))
-                            if rotate == 1 or rotate == 3:
-                                windowSurfaceObj.blit(image, (int((preview_width/2) - ((preview_height * (igwr/ighr)))/2),0))
+                        still_queue.put((rpistr,fname,extns2[extn],p,rotate,Pi_Cam,zoom,10 + sspeed/1000000))
+                        still_busy += 1
+                        still_open = 1
+                        
+                if button_column == 2 and still_open == 0:
+                    if button_row == 1 and event.button != 3 and prerec > 0 and codecs[codec] == 'h264':
+                        # PRE-RECORD VIDEO
+                        preview_stop()
+                        capture_buttons("CAPTURE","Pre-rec")
+                        text(0,0,6,2,1,"Pre-record armed, click CAPTURE to save",int(fv*1.7),1)
+                        rpistr = camera_cmd('video') + ("-t","0","--inline","--intra",str(fps),"-o","-")
+                        #print (rpistr)
+                        prerec_begin()
+                        p = subprocess.Popen(rpistr, preexec_fn=os.setsid, stdout=subprocess.PIPE)
+                        threading.Thread(target=prerec_reader, args=(p.stdout,), daemon=True).start()
+                        vname = ""
+                        stop = 0
+                        while stop == 0:
+                            display_flush()
+                            event = pygame.event.wait(250)
+                            pevents = pygame.event.get()
+                            if event.type != NOEVENT:
+                                pevents.insert(0,event)
+                            if p.poll() != None:
+                                stop = 1
+                            if vname == "":
+                                vlength = int(prerec_secs())
+                            elif vlen != 0:
+                                vlength = max(int(vlen - (time.monotonic()-start_video)),0)
                             else:
-                                windowSurfaceObj.blit(image, (0,0))
-                        dgain = 0
-                        again = 0
-                        etime = 0
-                        if os.path.exists("PiLibtext.txt"):
-                          with open("PiLibtext.txt", "r") as file:
-                            line = file.readline()
-                            check = line.split("=")
-                            if check[0] == "DigitalGain":
-                                dgain = check[1][:-1]
-                            if check[0] == "AnalogueGain":
-                                again = check[1][:-1]
-                            if check[0] == "ExposureTime":
-                                etime = check[1][:-1]
-                            while line:
-                                line = file.readline()
-                                check = line.split("=")
-                                if check[0] == "DigitalGain":
-                                    dgain = check[1][:-1]
-                                if check[0] == "AnalogueGain":
-                                    again = check[1][:-1]
-                                if check[0] == "ExposureTime":
-                                    etime = check[1][:-1]
-                          text(0,25,6,2,1,"Ana Gain: " + str(again) + " Dig Gain: " + str(dgain) + " Exp Time: " + str(etime) +"uS",int(fv*1.5),1)
-                        text(0,0,6,2,1,fname,int(fv*1.5),1)
-                        pygame.display.update()
-                        time.sleep(2)
-                        if rotate != 0:
-                            pygame.draw.rect(windowSurfaceObj,blackColor,Rect(0,0,preview_width,preview_height),0)
-                        button(0,0,0,4)
-                        text(0,0,1,0,1,"CAPTURE",ft,7)
-                        text(1,0,1,0,1,"CAPTURE",ft,7)
-                        text(1,0,1,1,1,"Video",ft,7)
-                        if Pi_Cam == 6 and mode == 0:
-                            text(0,0,1,1,1,"STILL    2x2",ft,7)
-                        else:
-                            text(0,0,1,1,1,"Still ",ft,7)
-                        text(1,9,1,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 6 and mode == 0 and tinterval > 0:
-                            text(1,9,1,1,1,"T'lapse  2x2",ft,7)
-                        else:
-                            text(1,9,1,1,1,"Timelapse",ft,7)
+                                vlength = int(time.monotonic()-start_video)
+                            td = timedelta(seconds=vlength)
+                            text(1,1,1,1,1,str(td),fv,11)
+                            for event in pevents:
+                                if event.type == PRERECDONE:
+                                    stop = 1
+                                elif (event.type == MOUSEBUTTONUP):
+                                    button_column,button_row = click_button(event.pos)
+                                    if button_column == 2 and button_row == 1 and vname == "":
+                                        # save the last prerec seconds and carry on recording
+                                        now = datetime.datetime.now()
+                                        timestamp = now.strftime("%y%m%d%H%M%S")
+                                        vname =  vid_dir + str(timestamp) + ".h264"
+                                        start_video = time.monotonic()
+                                        prerec_save(vname,vlen)
+                                        text(1,0,3,0,1,"STOP ",ft,0)
+                                        text(1,0,3,1,1,"Record",ft,0)
+                                        text(0,0,6,2,1,"Please Wait, taking video ...",int(fv*1.7),1)
+                                    elif button_column == 2 and button_row == 1:
+                                        stop = 1
+                        prerec_stop()
+                        if p.poll() == None:
+                            os.killpg(p.pid, signal.SIGTERM)
+                        if vname != "":
+                            text(0,0,6,2,1,vname,int(fv*1.5),1)
+                        capture_reset()
                         restart = 2
-                        
-                if button_column == 2:                       
-                    if button_row == 1 and event.button != 3:
+
+                    elif button_row == 1 and event.button != 3:
                         # TAKE VIDEO
-                        os.killpg(p.pid, signal.SIGTERM)
-                        button(1,0,1,3)
-                        text(1,0,3,0,1,"STOP ",ft,0)
-                        text(1,0,3,1,1,"Record",ft,0)
-                        text(0,0,0,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 6 and mode == 0 and tinterval > 0:
-                            text(0,0,0,1,1,"STILL    2x2",ft,7)
-                        else:
-                            text(0,0,0,1,1,"Still ",ft,7)
-                        text(1,9,0,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 6 and mode == 0 and tinterval > 0:
-                            text(1,9,0,1,1,"T'lapse  2x2",ft,7)
-                        else:
-                            text(1,9,0,1,1,"Timelapse",ft,7)
+                        preview_stop()
+                        capture_buttons("STOP ","Record")
                         text(0,0,6,2,1,"Please Wait, taking video ...",int(fv*1.7),1)
                         now = datetime.datetime.now()
                         timestamp = now.strftime("%y%m%d%H%M%S")
                         vname =  vid_dir + str(timestamp) + "." + codecs2[codec]
-                        if codecs2[codec] != 'raw':
-                            rpistr = "libcamera-vid --camera " + str(camera) + " -t " + str(vlen * 1000) + " -o " + vname
-                            if mode != 0:
-                                rpistr += " --framerate " + str(fps)
-                            else:
-                                speed7 = sspeed
-                                speed7 = max(speed7,int((1/fps)*1000000))
-                                rpistr += " --framerate " + str(int((1/speed7)*1000000))
-                            if codecs[codec] != 'h264' and codecs[codec] != 'mp4':
-                                rpistr += " --codec " + codecs[codec]
-                            else:
-                                prof = h264profiles[profile].split(" ")
-                                #rpistr += " --profile " + str(prof[0]) + " --level " + str(prof[1])
-                                rpistr += " --level " + str(prof[1])
-                        else:
-                            rpistr = "libcamera-raw --camera " + str(camera) + " -t " + str(vlen * 1000) + " -o " + vname + " --framerate " + str(fps)
-                        if vpreview == 0:
-                            rpistr += " -n "
-                        rpistr += " --brightness " + str(brightness/100) + " --contrast " + str(contrast/100)
-                        if zoom > 0:
-                            rpistr += " --width " + str(preview_width) + " --height " + str(preview_height)
-                        elif Pi_Cam == 4 and vwidth == 2028:
-                            rpistr += " --mode 2028:1520:12"
-                        elif Pi_Cam == 3 and vwidth == 2304 and codec == 0:
-                            rpistr += " --mode 2304:1296:10 --width 2304 --height 1296"
-                        elif Pi_Cam == 3 and vwidth == 2028 and codec == 0:
-                            rpistr += " --mode 2028:1520:10 --width 2028 --height 1520"
+                        tee = 0
+                        ff  = None
+                        tw  = None
+                        if vid_tee == 1 and prev_pipe > 0 and (codecs[codec] == 'mjpeg' or (codecs[codec] == 'h264' and tee_ffmpeg != None)):
+                            # record from stdout and show it in the preview
+                            tee = 1
+                            rpistr = camera_cmd('video') + ("-t",str(vlen * 1000),"-n","-o","-")
+                            if codecs[codec] == 'h264':
+                                # an I frame every second, so the preview recovers quickly after a drop
+                                rpistr += ("--inline","--intra",str(fps))
+                            p = subprocess.Popen(rpistr, preexec_fn=os.setsid, stdout=subprocess.PIPE)
+                            ff,tw = tee_start(p.stdout,vname)
+                            prev_seq = frame_seq
                         else:
-                            rpistr += " --width " + str(vwidth) + " --height " + str(vheight)
-                        if mode == 0:
-                            rpistr += " --shutter " + str(sspeed)
-                        else:
-                            rpistr += " --exposure " + modes[mode]
-                        rpistr += " --gain " + str(gain)
-                        if ev != 0:
-                            rpistr += " --ev " + str(ev)
-                        if awb == 0:
-                            rpistr += " --awbgains " + str(red/10) + "," + str(blue/10)
-                        else:
-                            rpistr += " --awb " + awbs[awb]
-                        rpistr += " --metering " + meters[meter]
-                        rpistr += " --saturation " + str(saturation/10)
-                        rpistr += " --sharpness " + str(sharpness/10)
-                        rpistr += " --denoise "    + denoises[denoise]
-                        if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0:
-                            rpistr += " --autofocus "
-                        if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
-                            rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode]
-                            if v3_f_mode == 1:
-                                rpistr += " --lens-position " + str(v3_focus/100)
-                        elif Pi_Cam == 3 and zoom == 0 and fxx != 0 and v3_f_mode != 1:
-                            rpistr += " --autofocus-window " + str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)
-                        if Pi_Cam == 3 and v3_f_speed != 0:
-                            rpistr += " --autofocus-speed " + v3_f_speeds[v3_f_speed]
-                        if Pi_Cam == 3 and v3_f_range != 0:
-                            rpistr += " --autofocus-range " + v3_f_ranges[v3_f_range]
-                        if Pi_Cam == 3 and v3_hdr == 1:
-                            rpistr += " --hdr"
-                        rpistr += " -p 0,0," + str(preview_width) + "," + str(preview_height)
-                        if zoom > 0 and zoom < 5:
-                            zxo = ((1920-zwidths[4 - zoom])/2)/1920
-                            zyo = ((1440-zheights[4 - zoom])/2)/1440
-                            rpistr += " --mode 1920:1440:10  --roi " + str(zxo) + "," + str(zyo) + "," + str(zwidths[4 - zoom]/1920) + "," + str(zheights[4 - zoom]/1440)
-                        if zoom == 5:
-                            zxo = ((igw/2)-(preview_width/2))/igw
-                            zyo = ((igh/2)-(preview_height/2))/igh
-                            rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)                            
+                            rpistr = camera_cmd('video') + ("-t",str(vlen * 1000),"-o",vname)
+                            p = subprocess.Popen(rpistr, preexec_fn=os.setsid)
                         #print (rpistr)
-                        p = subprocess.Popen(rpistr, shell=True, preexec_fn=os.setsid)
                         start_video = time.monotonic()
                         stop = 0
                         while (time.monotonic() - start_video < vlen or vlen == 0) and stop == 0:
+                            display_flush()
+                            event = pygame.event.wait(100)
+                            pevents = pygame.event.get()
+                            if event.type != NOEVENT:
+                                pevents.insert(0,event)
+                            if tee == 1:
+                                frm = frame_get(prev_seq)
+                                if frm != None:
+                                    prev_seq,image,luma = frm
+                                    if rotate == 1 or rotate == 3:
+                                        windowSurfaceObj.blit(image, (int((preview_width - image.get_width())/2),0))
+                                    else:
+                                        windowSurfaceObj.blit(image, (0,0))
+                                    dirty.append(Rect(0,0,preview_width,preview_height))
                             if vlen != 0:
                                 vlength = int(vlen - (time.monotonic()-start_video))
                             else:
                                 vlength = int(time.monotonic()-start_video)
                             td = timedelta(seconds=vlength)
                             text(1,1,1,1,1,str(td),fv,11)
-                            for event in pygame.event.get():
+                            for event in pevents:
                                 if (event.type == MOUSEBUTTONUP):
-                                    mousex, mousey = event.pos
                                     # stop video recording
-                                    if mousex > preview_width:
-                                        button_column = int((mousex-preview_width)/bw) + 1
-                                        button_row = int((mousey)/bh) + 1
-                                        if mousex > preview_width + bw + (bw/2):
-                                            button_pos = 1
-                                        else:
-                                            button_pos = 0
-                                    else:
-                                        if mousey - preview_height < bh:
-                                            button_column = 1
-                                            button_row = int(mousex / bw) + 1
-                                        elif mousey - preview_height < bh * 2:
-                                            button_column = 1
-                                            button_row = int(mousex / bw) + 7
-                                        elif mousey - preview_height < bh * 3:
-                                            button_column = 2
-                                            button_row = int(mousex / bw) + 1
-                                        elif mousey - preview_height < bh * 4:
-                                            button_column = 2
-                                            button_row = int(mousex / bw) + 7
+                                    button_column,button_row = click_button(event.pos)
                                     if button_column == 2 and button_row == 1:
                                        os.killpg(p.pid, signal.SIGTERM)
                                        stop = 1
+                        if tw != None:
+                            # the file is written and closed by the recording thread
+                            p.wait()
+                            tw.join()
+                        if ff != None:
+                            try:
+                                ff.wait(timeout=2)
+                            except subprocess.TimeoutExpired:
+                                ff.kill()
                         text(0,0,6,2,1,vname,int(fv*1.5),1)
+                        display_flush()
                         time.sleep(1)
-                        td = timedelta(seconds=vlen)
-                        if rotate != 0:
-                            pygame.draw.rect(windowSurfaceObj,blackColor,Rect(0,0,preview_width,preview_height),0)
-                        text(1,1,3,1,1,str(td),fv,11)
-                        button(1,0,0,3)
-                        text(0,0,1,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 5 and mode == 0:
-                            text(0,0,1,1,1,"STILL    2x2",ft,7)
-                        else:
-                            text(0,0,1,1,1,"Still ",ft,7)
-                        text(1,0,1,0,1,"CAPTURE",ft,7)
-                        text(1,0,1,1,1,"Video",ft,7)
-                        text(1,9,1,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 5 and mode == 0 and tinterval > 0:
-                            text(1,9,1,1,1,"T'lapse  2x2",ft,7)
-                        else:
-                            text(1,9,1,1,1,"Timelapse",ft,7)
+                        capture_reset()
                         restart = 2
                                        
                     elif button_row == 1 and event.button == 3:
                         # STREAM VIDEO
-                        os.killpg(p.pid, signal.SIGTERM)
-                        button(1,0,1,3)
-                        text(1,0,3,0,1,"STOP ",ft,0)
-                        text(1,0,3,1,1,"STREAM",ft,0)
-                        text(0,0,0,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 6 and mode == 0 and tinterval > 0:
-                            text(0,0,0,1,1,"STILL    2x2",ft,7)
-                        else:
-                            text(0,0,0,1,1,"Still ",ft,7)
-                        text(1,9,0,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 6 and mode == 0 and tinterval > 0:
-                            text(1,9,0,1,1,"T'lapse  2x2",ft,7)
-                        else:
-                            text(1,9,0,1,1,"Timelapse",ft,7)
+                        preview_stop()
+                        capture_buttons("STOP ","STREAM")
                         text(0,0,6,2,1,"Streaming Video ...",int(fv*1.7),1)
                         now = datetime.datetime.now()
                         timestamp = now.strftime("%y%m%d%H%M%S")
                         vname =  vid_dir + str(timestamp) + "." + codecs2[codec]
-                        rpistr = "libcamera-vid --camera " + str(camera) + " -t " + str(vlen * 1000) + " --inline --listen -o tcp://0.0.0.0:" + str(stream_port)
-                        if mode != 0:
-                            rpistr += " --framerate " + str(fps)
-                        else:
-                            speed7 = sspeed
-                            speed7 = max(speed7,int((1/fps)*1000000))
-                            rpistr += " --framerate " + str(int((1/speed7)*1000000))
-                        prof = h264profiles[profile].split(" ")
-                        rpistr += " --profile " + str(prof[0]) + " --level " + str(prof[1])
-                        if vpreview == 0:
-                            rpistr += " -n "
-                        rpistr += " --brightness " + str(brightness/100) + " --contrast " + str(contrast/100)
-                        if zoom > 0:
-                            rpistr += " --width " + str(preview_width) + " --height " + str(preview_height)
-                        elif Pi_Cam == 4 and vwidth == 2028:
-                            rpistr += " --mode 2028:1520:12"
-                        elif Pi_Cam == 3 and vwidth == 2304 and codec == 0:
-                            rpistr += " --mode 2304:1296:10 --width 2304 --height 1296"
-                        elif Pi_Cam == 3 and vwidth == 2028 and codec == 0:
-                            rpistr += " --mode 2028:1520:10 --width 2028 --height 1520"
-                        else:
-                            rpistr += " --width " + str(vwidth) + " --height " + str(vheight)
-                        if mode == 0:
-                            rpistr += " --shutter " + str(sspeed)
-                        else:
-                            rpistr += " --exposure " + modes[mode]
-                        rpistr += " --gain " + str(gain)
-                        if ev != 0:
-                            rpistr += " --ev " + str(ev)
-                        if awb == 0:
-                            rpistr += " --awbgains " + str(red/10) + "," + str(blue/10)
+                        if stream_fan == 1:
+                            # one camera, many viewers
+                            rpistr = tuple([a for a in camera_cmd('stream') if a != "--listen"]) + ("-t",str(vlen * 1000),"-o","-")
+                            p = subprocess.Popen(rpistr, preexec_fn=os.setsid, stdout=subprocess.PIPE)
+                            fan = threading.Thread(target=stream_serve, args=(p.stdout,), daemon=True)
+                            fan.start()
                         else:
-                            rpistr += " --awb " + awbs[awb]
-                        rpistr += " --metering " + meters[meter]
-                        rpistr += " --saturation " + str(saturation/10)
-                        rpistr += " --sharpness " + str(sharpness/10)
-                        rpistr += " --denoise "    + denoises[denoise]
-                        if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0:
-                            rpistr += " --autofocus "
-                        if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
-                            rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode]
-                            if v3_f_mode == 1:
-                                rpistr += " --lens-position " + str(v3_focus/100)
-                        elif Pi_Cam == 3 and zoom == 0 and fxx != 0 and v3_f_mode != 1:
-                            rpistr += " --autofocus-window " + str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)
-                        if Pi_Cam == 3 and v3_f_speed != 0:
-                            rpistr += " --autofocus-speed " + v3_f_speeds[v3_f_speed]
-                        if Pi_Cam == 3 and v3_f_range != 0:
-                            rpistr += " --autofocus-range " + v3_f_ranges[v3_f_range]
-                        if Pi_Cam == 3 and v3_hdr == 1:
-                            rpistr += " --hdr"
-                        rpistr += " -p 0,0," + str(preview_width) + "," + str(preview_height)
-                        if zoom > 0 and zoom < 5:
-                            zxo = ((1920-zwidths[4 - zoom])/2)/1920
-                            zyo = ((1440-zheights[4 - zoom])/2)/1440
-                            rpistr += " --mode 1920:1440:10  --roi " + str(zxo) + "," + str(zyo) + "," + str(zwidths[4 - zoom]/1920) + "," + str(zheights[4 - zoom]/1440)
-                        if zoom == 5:
-                            zxo = ((igw/2)-(preview_width/2))/igw
-                            zyo = ((igh/2)-(preview_height/2))/igh
-                            rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)                            
+                            rpistr = camera_cmd('stream') + ("-t",str(vlen * 1000),"-o","tcp://0.0.0.0:" + str(stream_port))
+                            p = subprocess.Popen(rpistr, preexec_fn=os.setsid)
                         #print (rpistr)
-                        p = subprocess.Popen(rpistr, shell=True, preexec_fn=os.setsid)
                         start_video = time.monotonic()
                         stop = 0
+                        viewers = -1
                         while (time.monotonic() - start_video < vlen or vlen == 0) and stop == 0:
+                            display_flush()
+                            event = pygame.event.wait(250)
+                            pevents = pygame.event.get()
+                            if event.type != NOEVENT:
+                                pevents.insert(0,event)
+                            if stream_fan == 1 and stream_count() != viewers:
+                                viewers = stream_count()
+                                text(0,0,6,2,1,"Streaming Video ... " + str(viewers) + " viewing",int(fv*1.7),1)
                             if vlen != 0:
                                 vlength = int(vlen - (time.monotonic()-start_video))
                             else:
                                 vlength = int(time.monotonic()-start_video)
                             td = timedelta(seconds=vlength)
                             text(1,1,1,1,1,str(td),fv,11)
-                            for event in pygame.event.get():
+                            for event in pevents:
                                 if (event.type == MOUSEBUTTONUP):
-                                    mousex, mousey = event.pos
                                     # stop video streaming
-                                    if mousex > preview_width:
-                                        button_column = int((mousex-preview_width)/bw) + 1
-                                        button_row = int((mousey)/bh) + 1
-                                        if mousex > preview_width + bw + (bw/2):
-                                            button_pos = 1
-                                        else:
-                                            button_pos = 0
-                                    else:
-                                        if mousey - preview_height < bh:
-                                            button_column = 1
-                                            button_row = int(mousex / bw) + 1
-                                        elif mousey - preview_height < bh * 2:
-                                            button_column = 1
-                                            button_row = int(mousex / bw) + 7
-                                        elif mousey - preview_height < bh * 3:
-                                            button_column = 2
-                                            button_row = int(mousex / bw) + 1
-                                        elif mousey - preview_height < bh * 4:
-                                            button_column = 2
-                                            button_row = int(mousex / bw) + 7
+                                    button_column,button_row = click_button(event.pos)
                                     if button_column == 2 and button_row == 1:
                                        os.killpg(p.pid, signal.SIGTERM)
                                        stop = 1
-                        td = timedelta(seconds=vlen)
-                        if rotate != 0:
-                            pygame.draw.rect(windowSurfaceObj,blackColor,Rect(0,0,preview_width,preview_height),0)
-                        text(1,1,3,1,1,str(td),fv,11)
-                        button(1,0,0,3)
-                        text(0,0,1,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 5 and mode == 0:
-                            text(0,0,1,1,1,"STILL    2x2",ft,7)
-                        else:
-                            text(0,0,1,1,1,"Still ",ft,7)
-                        text(1,0,1,0,1,"CAPTURE",ft,7)
-                        text(1,0,1,1,1,"Video",ft,7)
-                        text(1,9,1,0,1,"CAPTURE",ft,7)
-                        if Pi_Cam == 5 and mode == 0 and tinterval > 0:
-                            text(1,9,1,1,1,"T'lapse  2x2",ft,7)
-                        else:
-                            text(1,9,1,1,1,"Timelapse",ft,7)
+                        if stream_fan == 1:
+                            fan.join(2)
+                        capture_reset()
                         restart = 2
                         
                     elif button_row == 10:
@@ -2961,82 +4175,30 @@ while True:
                             timestamp = now.strftime("%y%m%d%H%M%S")
                             count = 0
                             fname =  pic_dir + str(timestamp) + '_%04d.' + extns2[extn]
-                            if extns[extn] != 'raw':
-                                rpistr = "libcamera-still --camera " + str(camera) + " -e " + extns[extn] + " -s -n -t 0 -o " + fname
-                            else:
-                                rpistr = "libcamera-still --camera " + str(camera) + " -r -s -n -t 0 -o " + fname 
-                                if preview_width == 640 and preview_height == 480 and zoom >= 4:
-                                    rpistr += " --rawfull"
-                            rpistr += " --brightness " + str(brightness/100) + " --contrast " + str(contrast/100)
-                            if extns[extn] == "jpg" and preview_width == 640 and preview_height == 480 and zoom >= 4:
-                                rpistr += " -r --rawfull"
-                            if mode == 0:
-                                rpistr += " --shutter " + str(sspeed)
-                            else:
-                                rpistr += " --exposure " + modes[mode]
-                            if ev != 0:
-                                rpistr += " --ev " + str(ev)
-                            if sspeed > 1000000 and mode == 0 and (Pi_Cam < 5 or Pi_Cam == 7):
-                                rpistr += " --gain " + str(gain) + " --immediate --awbgains " + str(red/10) + "," + str(blue/10)
+                            if mode == 0 and button_pos == 2:
+                                rpistr = camera_cmd('tlstill',1) + ("-s","-t","0","-o",fname)
                             else:
-                                rpistr += " --gain " + str(gain)
-                                if awb == 0:
-                                    rpistr += " --awbgains " + str(red/10) + "," + str(blue/10)
-                                else:
-                                    rpistr += " --awb " + awbs[awb]
-                            rpistr += " --metering " + meters[meter]
-                            rpistr += " --saturation " + str(saturation/10)
-                            rpistr += " --sharpness " + str(sharpness/10)
-                            rpistr += " --quality " + str(quality)
-                            rpistr += " --denoise "    + denoises[denoise]
-                            if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0 and tinterval > 5:
-                                rpistr += " --autofocus "
-                            if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
-                                rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode]
-                                if v3_f_mode == 1:
-                                    rpistr += " --lens-position " + str(v3_focus/100)
-                            elif Pi_Cam == 3 and v3_f_mode == 0 and fxz == 1:
-                                rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode] + " --autofocus-on-capture"
-                            elif Pi_Cam == 3 and zoom == 0:
-                                rpistr += " --autofocus-window " + str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)
-                            if  v3_hdr == 1:
-                                rpistr += " --hdr"
-                            if Pi_Cam == 6 and mode == 0 and button_pos == 2:
-                                rpistr += " --width 4624 --height 3472 " # 16MP superpixel mode for higher light sensitivity
-                            elif Pi_Cam == 6:
-                                rpistr += " --width 9152 --height 6944"
-                            if zoom > 0 and zoom < 5:
-                                zxo = ((igw-zws[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igw
-                                zyo = ((igh-zhs[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igh
-                                rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(zws[(4-zoom) + ((Pi_Cam-1)* 4)]/igw) + "," + str(zhs[(4-zoom) + ((Pi_Cam-1)* 4)]/igh)
-                            if zoom == 5:
-                                zxo = ((igw/2)-(preview_width/2))/igw
-                                zyo = ((igh/2)-(preview_height/2))/igh
-                                rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)
-                            p = subprocess.Popen(rpistr, shell=True, preexec_fn=os.setsid)
+                                rpistr = camera_cmd('tlstill') + ("-s","-t","0","-o",fname)
+                            watch_start(timestamp)
+                            p = subprocess.Popen(rpistr, preexec_fn=os.setsid)
                             #print (rpistr)
                             start_timelapse = time.monotonic()
                             start2 = time.monotonic()
                             stop = 0
-                            pics3 = []
                             count = 0
                             old_count = 0
                             while count < tshots and stop == 0:
+                                display_flush()
                                 if time.monotonic() - start2 >= tinterval:
-                                    os.system('pkill -SIGUSR1 libcamera-still')
+                                    os.kill(p.pid, signal.SIGUSR1)
                                     start2 = time.monotonic()
                                     text(0,0,6,2,1,"Please Wait, taking Timelapse ..."  + " " + str(count+1),int(fv*1.7),1)
                                     show = 0
                                     while count == old_count:
+                                        display_flush()
                                         time.sleep(0.1)
-                                        pics3 = glob.glob(pic_dir + "*.*")
-                                        counts = []
-                                        for xu in range(0,len(pics3)):
-                                            ww = pics3[xu].split("/")
-                                            if ww[4][0:12] == timestamp:
-                                                counts.append(pics3[xu])
+                                        counts = watch_count(fname % count)
                                         count = len(counts)
-                                        counts.sort()
                                         for event in pygame.event.get():
                                             if (event.type == MOUSEBUTTONUP):
                                                 mousex, mousey = event.pos
@@ -3094,6 +4256,7 @@ while True:
                                             text(1,12,3,1,1,str(tshots),fv,12)
                                             stop = 1
                                             count = tshots
+                            watch_stop()
 
                         elif tinterval > 0 and mode == 0:
                             text(1,9,3,0,1,"STOP",ft,0)
@@ -3103,10 +4266,11 @@ while True:
                             timestamp = now.strftime("%y%m%d%H%M%S")
                             start2 = time.monotonic()
                             stop = 0
-                            pics3 = []
                             count = 0
                             old_count = 0
+                            watch_start(timestamp)
                             while count < tshots and stop == 0:
+                                display_flush()
                                 if time.monotonic() - start2 > tinterval:
                                     start2 = time.monotonic()
                                     poll = p.poll()
@@ -3114,69 +4278,19 @@ while True:
                                         poll = p.poll()
                                         time.sleep(0.1)
                                     fname =  pic_dir + str(timestamp) + "_" + str(count) + "." + extns2[extn]
-                                    if extns[extn] != 'raw':
-                                        rpistr = "libcamera-still --camera " + str(camera) + " -e " + extns[extn] + " -n -t 1000 -o " + fname
+                                    if mode == 0 and button_pos == 2:
+                                        rpistr = camera_cmd('tlstill',1) + ("-t","1000","-o",fname)
                                     else:
-                                        rpistr = "libcamera-still --camera " + str(camera) + " -r -n -t 1000 -o " + fname 
-                                        if preview_width == 640 and preview_height == 480 and zoom >= 4:
-                                            rpistr += " --rawfull"
-                                    rpistr += " --brightness " + str(brightness/100) + " --contrast " + str(contrast/100)
-                                    if extns[extn] == "jpg" and preview_width == 640 and preview_height == 480 and zoom >= 4:
-                                        rpistr += " -r --rawfull"
-                                    rpistr += " --shutter " + str(sspeed)
-                                    if ev != 0:
-                                        rpistr += " --ev " + str(ev)
-                                    if sspeed > 1000000 and mode == 0 and (Pi_Cam < 5 or Pi_Cam == 7):
-                                        rpistr += " --gain " + str(gain) + " --immediate --awbgains " + str(red/10) + "," + str(blue/10)
-                                    else:
-                                        rpistr += " --gain " + str(gain)
-                                        if awb == 0:
-                                            rpistr += " --awbgains " + str(red/10) + "," + str(blue/10)
-                                        else:
-                                            rpistr += " --awb " + awbs[awb]
-                                    rpistr += " --metering " + meters[meter]
-                                    rpistr += " --saturation " + str(saturation/10)
-                                    rpistr += " --sharpness " + str(sharpness/10)
-                                    rpistr += " --quality " + str(quality)
-                                    rpistr += " --denoise "    + denoises[denoise]
-                                    if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0 and tinterval > 5:
-                                        rpistr += " --autofocus "
-                                    if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
-                                        rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode]
-                                        if v3_f_mode == 1:
-                                            rpistr += " --lens-position " + str(v3_focus/100)
-                                    elif Pi_Cam == 3 and v3_f_mode == 0 and fxz == 1:
-                                        rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode] + " --autofocus-on-capture"
-                                    elif Pi_Cam == 3 and zoom == 0:
-                                        rpistr += " --autofocus-window " + str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)
-                                    if  v3_hdr == 1:
-                                        rpistr += " --hdr"
-                                    if Pi_Cam == 6 and mode == 0 and button_pos == 2:
-                                        rpistr += " --width 4624 --height 3472 " # 16MP superpixel mode for higher light sensitivity
-                                    elif Pi_Cam == 6:
-                                        rpistr += " --width 9152 --height 6944"
-                                    if zoom > 0 and zoom < 5:
-                                        zxo = ((igw-zws[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igw
-                                        zyo = ((igh-zhs[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igh
-                                        rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(zws[(4-zoom) + ((Pi_Cam-1)* 4)]/igw) + "," + str(zhs[(4-zoom) + ((Pi_Cam-1)* 4)]/igh)
-                                    if zoom == 5:
-                                        zxo = ((igw/2)-(preview_width/2))/igw
-                                        zyo = ((igh/2)-(preview_height/2))/igh
-                                        rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)
+                                        rpistr = camera_cmd('tlstill') + ("-t","1000","-o",fname)
                                     #print(rpistr)
-                                    p = subprocess.Popen(rpistr, shell=True, preexec_fn=os.setsid)
+                                    p = subprocess.Popen(rpistr, preexec_fn=os.setsid)
                                     text(0,0,6,2,1,"Please Wait, taking Timelapse ..."  + " " + str(count+1),int(fv*1.7),1)
                                     show = 0
                                     while count == old_count:
+                                        display_flush()
                                         time.sleep(0.1)
-                                        pics3 = glob.glob(pic_dir + "*.*")
-                                        counts = []
-                                        for xu in range(0,len(pics3)):
-                                            ww = pics3[xu].split("/")
-                                            if ww[4][0:12] == timestamp:
-                                                counts.append(pics3[xu])
+                                        counts = watch_count(fname)
                                         count = len(counts)
-                                        counts.sort()
                                         if (extns2[extn] == 'jpg' or extns2[extn] == 'bmp' or extns2[extn] == 'png') and count > 0 and show == 0:
                                             image = pygame.image.load(counts[count-1])
                                             if (Pi_Cam != 3) or (Pi_Cam == 3 and zoom == 5):
@@ -3185,7 +4299,7 @@ while True:
                                                 catSurfacesmall = pygame.transform.scale(image, (preview_width,int(preview_height * 0.75)))
                                             windowSurfaceObj.blit(catSurfacesmall, (0, 0))
                                             text(0,0,6,2,1,counts[count-1],int(fv*1.5),1)
-                                            pygame.display.update()
+                                            dirty.append(Rect(0,0,preview_width,preview_height))
                                             show == 1
                                         for event in pygame.event.get():
                                             if (event.type == MOUSEBUTTONUP):
@@ -3244,7 +4358,7 @@ while True:
                                             text(1,12,3,1,1,str(tshots),fv,12)
                                             stop = 1
                                             count = tshots
-
+                            watch_stop()
 
                         elif tinterval == 0:
                             if tduration == 0:
@@ -3253,57 +4367,15 @@ while True:
                             now = datetime.datetime.now()
                             timestamp = now.strftime("%y%m%d%H%M%S")
                             fname =  pic_dir + str(timestamp) + '_%04d.' + extns2[extn]
-                            if codecs2[codec] != 'raw':
-                                rpistr = "libcamera-vid --camera " + str(camera) + " -n --codec mjpeg -t " + str(tduration*1000) + " --segment 1 -o " + fname
-                            else:
+                            if codecs2[codec] == 'raw':
                                 fname =  pic_dir + str(timestamp) + '_%04d.' + codecs2[codec]
-                                rpistr = "libcamera-raw --camera " + str(camera) + " -n -t " + str(tduration*1000) + " --segment 1 -o " + fname  
-                            if zoom > 0:
-                                rpistr += " --width " + str(preview_width) + " --height " + str(preview_height)
-                            else:
-                                rpistr += " --width " + str(vwidth) + " --height " + str(vheight)
-                            rpistr += " --brightness " + str(brightness/100) + " --contrast " + str(contrast/100)
-                            if mode == 0:
-                                rpistr += " --shutter " + str(sspeed) + " --framerate " + str(1000000/sspeed)
-                            else:
-                                rpistr += " --exposure " + str(modes[mode]) + " --framerate " + str(fps)
-                            if ev != 0:
-                                rpistr += " --ev " + str(ev)
-                            if sspeed > 5000000 and mode == 0 and (Pi_Cam < 5 or Pi_Cam == 7):
-                                rpistr += " --gain 1 --immediate --awbgains " + str(red/10) + "," + str(blue/10)
-                            else:
-                                rpistr += " --gain " + str(gain)
-                                if awb == 0:
-                                    rpistr += " --awbgains " + str(red/10) + "," + str(blue/10)
-                                else:
-                                    rpistr += " --awb " + awbs[awb]
-                            rpistr += " --metering "   + meters[meter]
-                            rpistr += " --saturation " + str(saturation/10)
-                            rpistr += " --sharpness "  + str(sharpness/10)
-                            rpistr += " --denoise "    + denoises[denoise]
-                            if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0:
-                                rpistr += " --autofocus "
-                            if Pi_Cam == 3 and v3_f_mode > 0 and fxx == 0:
-                                rpistr += " --autofocus-mode " + v3_f_modes[v3_f_mode]
-                                if v3_f_mode == 1:
-                                    rpistr += " --lens-position " + str(v3_focus/100)
-                            elif Pi_Cam == 3 and zoom == 0:
-                                rpistr += " --autofocus-window " + str(fxx) + "," + str(fxy) + "," + str(fxz) + "," + str(fxz)
-                            if Pi_Cam == 3 and v3_hdr == 1:
-                                rpistr += " --hdr"
-                            if zoom > 0 and zoom < 5 :
-                                zxo = ((igw-zws[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igw
-                                zyo = ((igh-zhs[(4-zoom) + ((Pi_Cam-1)* 4)])/2)/igh
-                                rpistr += " --mode 1920:1440:10 --roi " + str(zxo) + "," + str(zyo) + "," + str(zws[(4-zoom) + ((Pi_Cam-1)* 4)]/igw) + "," + str(zhs[(4-zoom) + ((Pi_Cam-1)* 4)]/igh)
-                            if zoom == 5:
-                                zxo = ((igw/2)-(preview_width/2))/igw
-                                zyo = ((igh/2)-(preview_height/2))/igh
-                                rpistr += " --roi " + str(zxo) + "," + str(zyo) + "," + str(preview_width/igw) + "," + str(preview_height/igh)
+                            rpistr = camera_cmd('tlvid') + ("-t",str(tduration*1000),"--segment","1","-o",fname)
                             #print (rpistr)
-                            p = subprocess.Popen(rpistr, shell=True, preexec_fn=os.setsid)
+                            p = subprocess.Popen(rpistr, preexec_fn=os.setsid)
                             start_timelapse = time.monotonic()
                             stop = 0
                             while time.monotonic() - start_timelapse < tduration+1 and stop == 0:
+                                display_flush()
                                 tdur = int(tduration - (time.monotonic() - start_timelapse))
                                 td = timedelta(seconds=tdur)
                                 text(1,10,1,1,1,str(td),fv,12)
@@ -3350,11 +4422,9 @@ while True:
                         else:
                             text(1,9,1,1,1,"Timelapse",ft,7)
                         restart = 2
-        # RESTART
-        if restart > 0:
-            poll = p.poll()
-            if poll == None:
-                os.killpg(p.pid, signal.SIGTERM)
+        # RESTART after a capture
+        if restart > 1 and still_open == 0:
+            preview_stop()
             if rotate == 0:
                 text(0,0,6,2,1,"Waiting for preview ...",int(fv*1.7),1)
             preview()
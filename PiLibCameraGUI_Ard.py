@@ -29,7 +29,8 @@ import glob
 from datetime import timedelta
 import numpy as np
 import math
-import random
+import fcntl
+import struct
 
 
 # version v4.61ard
@@ -103,14 +104,90 @@ max_16mp    = 200
 max_64mp    = 435
 max_gs      = 15
 
+# FOCUS METRICS
+# focus values for a grey (or Y plane) crop, worked in float32 in buffers kept between frames.
+# 'laplacian' = variance of the laplacian, 'tenengrad' = mean sobel gradient energy,
+# 'variance' = grey level variance / mean, 'brenner' = mean squared difference of pixels 2 apart.
+# step > 1 takes every step'th pixel first for a quicker value from a large area.
+# python3 PiLibCameraGUI_Ard.py --focus-bench DIR times each metric on the jpgs in DIR, taken in name order
+# through a focus sweep, and shows how cleanly each one rises to a single peak.
+focus_metrics = ('laplacian','tenengrad','variance','brenner')
+focus_f32     = np.empty((0,0),np.float32)
+focus_gx      = np.empty((0,0),np.float32)
+focus_gy      = np.empty((0,0),np.float32)
+
+def focus_value(gray,metric,step=1):
+    global focus_f32,focus_gx,focus_gy
+    if step > 1:
+        gray = gray[::step,::step]
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0
+    if metric == 'variance':
+        mean,dev = cv2.meanStdDev(gray)
+        if mean[0][0] == 0:
+            return 0
+        return (dev[0][0] * dev[0][0])/mean[0][0]
+    if focus_f32.shape != gray.shape:
+        focus_f32 = np.empty(gray.shape,np.float32)
+        focus_gx  = np.empty(gray.shape,np.float32)
+        focus_gy  = np.empty(gray.shape,np.float32)
+    np.copyto(focus_f32,gray)
+    if metric == 'tenengrad':
+        cv2.Sobel(focus_f32,cv2.CV_32F,1,0,dst=focus_gx,ksize=3)
+        cv2.Sobel(focus_f32,cv2.CV_32F,0,1,dst=focus_gy,ksize=3)
+        cv2.multiply(focus_gx,focus_gx,dst=focus_gx)
+        cv2.multiply(focus_gy,focus_gy,dst=focus_gy)
+        cv2.add(focus_gx,focus_gy,dst=focus_gx)
+        return cv2.mean(focus_gx)[0]
+    if metric == 'brenner':
+        w = gray.shape[1] - 2
+        dif = focus_gx[:,:w]
+        cv2.subtract(focus_f32[:,2:],focus_f32[:,:w],dst=dif)
+        cv2.multiply(dif,dif,dst=dif)
+        return cv2.mean(dif)[0]
+    cv2.Laplacian(focus_f32,cv2.CV_32F,dst=focus_gx)
+    dev = cv2.meanStdDev(focus_gx)[1][0][0]
+    return dev * dev
+
+def focus_bench(bdir):
+    files = sorted(glob.glob(os.path.join(bdir,"*.jpg")))
+    if len(files) < 2:
+        print("focus bench needs a focus sweep of jpgs in " + bdir)
+        return
+    grays = []
+    for f in files:
+        gray = cv2.imread(f,cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            continue
+        h,w = gray.shape
+        grays.append(gray[int(h/2)-histarea:int(h/2)+histarea,int(w/2)-histarea:int(w/2)+histarea])
+    print(str(len(grays)) + " frames, " + str(histarea * 2) + "x" + str(histarea * 2) + " centre crop")
+    print("metric      step    ms/frame  peak  turns  peak/min")
+    for metric in focus_metrics:
+        for step in (1,2):
+            start = time.perf_counter()
+            vals = [focus_value(gray,metric,step) for gray in grays]
+            ms = (time.perf_counter() - start) * 1000/len(grays)
+            # a good metric rises to one peak and falls, 1 turn
+            dirs  = [1 if vals[n+1] > vals[n] else -1 for n in range(0,len(vals)-1) if vals[n+1] != vals[n]]
+            turns = len([n for n in range(0,len(dirs)-1) if dirs[n+1] != dirs[n]])
+            peak  = vals.index(max(vals))
+            ratio = max(vals)/max(min(vals),1e-9)
+            print("%-11s %4d %11.3f %5d %6d %9.1f" % (metric,step,ms,peak,turns,ratio))
+
+if len(sys.argv) > 2 and sys.argv[1] == "--focus-bench":
+    focus_bench(sys.argv[2])
+    sys.exit()
+
 # inital parameters
 focus       = 2000
 foc_man     = 0
-fcount      = 0
-fstep       = 10
-max_fcount  = 30
-old_foc     = 0
-ran         = 0
+af_range    = (100,4000) # Arducam AF lens positions searched
+af_coarse   = 7      # positions in the AF coarse sweep
+af_settle   = 2      # preview frames still in libcamera's pipeline when the AF moves the lens
+af_tol      = 32     # AF stops when the best position is known to within this
+af_metric   = 'laplacian' # focus value used by the AF, see FOCUS METRICS
+focus_metric = 'laplacian' # focus value shown in zoom and manual focus
 prev_fps    = 10 
 focus_fps   = 25 
 focus_mode  = 0
@@ -375,6 +452,152 @@ if shutter < 0:
 sspeed = int(shutter * 1000000)
 if (shutter * 1000000) - int(shutter * 1000000) > 0.5:
     sspeed +=1
+# FOCUS ACTUATOR
+# the lens driver is opened once and driven with V4L2 ioctls instead of running v4l2-ctl for every step
+focus_dev     = "/dev/v4l-subdev1"
+focus_fd      = -1
+VIDIOC_G_CTRL = 0xc008561b
+VIDIOC_S_CTRL = 0xc008561c
+V4L2_CID_FOCUS_ABSOLUTE = 0x009a090a
+
+def focus_open():
+    global focus_fd
+    if focus_fd < 0:
+        try:
+            focus_fd = os.open(focus_dev,os.O_RDWR)
+        except OSError:
+            focus_fd = -1
+    return focus_fd
+
+def focus_close():
+    global focus_fd
+    if focus_fd >= 0:
+        os.close(focus_fd)
+    focus_fd = -1
+
+def focus_set(value):
+    if focus_open() >= 0:
+        try:
+            fcntl.ioctl(focus_fd,VIDIOC_S_CTRL,struct.pack('Ii',V4L2_CID_FOCUS_ABSOLUTE,int(value)))
+            return
+        except OSError:
+            focus_close()
+    os.system("v4l2-ctl -d " + focus_dev + " -c focus_absolute=" + str(int(value)))
+
+def focus_get():
+    if focus_open() >= 0:
+        try:
+            ctrl = bytearray(struct.pack('Ii',V4L2_CID_FOCUS_ABSOLUTE,0))
+            fcntl.ioctl(focus_fd,VIDIOC_G_CTRL,ctrl)
+            return struct.unpack('Ii',ctrl)[1]
+        except OSError:
+            focus_close()
+    try:
+        ctrl = subprocess.check_output(["v4l2-ctl","-d",focus_dev,"-C","focus_absolute"]).decode()
+        return int(ctrl.split(':')[1])
+    except (OSError,subprocess.CalledProcessError,IndexError,ValueError):
+        return None
+
+# ARDUCAM AF
+# a coarse sweep of af_range, then a golden section search between the neighbours of the best position.
+# af_frame() is given the focus value of a preview frame and returns the next lens position,
+# or None to leave the lens alone. After each move af_seq is set to the newest /run/shm segment number
+# plus af_settle, and only a frame numbered after it is scored, so the value is from a frame taken
+# with the lens in its new position. The search is deterministic and stops after about
+# af_coarse + 8 moves, af_lock then holds the position, number of moves and time taken.
+af_gold  = (math.sqrt(5) - 1)/2
+af_state = 0       # 0 = off or locked, 1 = coarse sweep, 2 = golden section
+af_pos   = []
+af_vals  = []
+af_seq   = -1      # segment number a scored frame has to be after
+af_moves = 0
+af_time  = 0
+af_lock  = ""
+af_a     = 0       # bracket a < c < d < b, with focus values fc and fd
+af_b     = 0
+af_c     = 0
+af_d     = 0
+af_fc    = None
+af_fd    = None
+af_want  = 'c'     # which of c or d the next value is for
+
+def af_begin():
+    # only the Arducam AF cameras in auto focus, otherwise the main loop would keep polling for AF frames
+    global af_state,af_pos,af_vals,af_seq,af_moves,af_time,af_lock
+    if (Pi_Cam != 5 and Pi_Cam != 6) or foc_man != 0:
+        af_state = 0
+        return
+    af_state = 1
+    af_pos   = [int(af_range[0] + ((af_range[1] - af_range[0]) * n)/(af_coarse - 1)) for n in range(0,af_coarse)]
+    af_vals  = []
+    af_seq   = -1
+    af_moves = 0
+    af_time  = time.monotonic()
+    af_lock  = ""
+
+def shm_frames():
+    # preview segments in /run/shm, oldest first, the last one may still be being written
+    pics = glob.glob('/run/shm/test*.jpg')
+    pics.sort(key = shm_seq)
+    return pics
+
+def shm_seq(pic):
+    return int(os.path.basename(pic)[4:-4])
+
+def af_move(pos):
+    global af_moves
+    af_moves += 1
+    return int(pos)
+
+def af_frame(foc):
+    global af_state,af_lock,af_a,af_b,af_c,af_d,af_fc,af_fd,af_want
+    if af_state == 0:
+        return None
+    if af_state == 1:
+        # the first frame only moves the lens to the start of the sweep
+        if af_moves > 0:
+            af_vals.append(foc)
+        if len(af_vals) < len(af_pos):
+            return af_move(af_pos[len(af_vals)])
+        best = af_vals.index(max(af_vals))
+        af_a = af_pos[max(best - 1,0)]
+        af_b = af_pos[min(best + 1,len(af_pos) - 1)]
+        af_c = af_b - (af_b - af_a) * af_gold
+        af_d = af_a + (af_b - af_a) * af_gold
+        af_fc = None
+        af_fd = None
+        af_want = 'c'
+        af_state = 2
+        return af_move(af_c)
+    if af_want == 'c':
+        af_fc = foc
+    else:
+        af_fd = foc
+    if af_fd == None:
+        af_want = 'd'
+        return af_move(af_d)
+    # keep the part of the bracket with the higher value, one new point is needed each time
+    if af_fc >= af_fd:
+        af_b  = af_d
+        af_d  = af_c
+        af_fd = af_fc
+        af_c  = af_b - (af_b - af_a) * af_gold
+        af_want = 'c'
+        pos = af_c
+    else:
+        af_a  = af_c
+        af_c  = af_d
+        af_fc = af_fd
+        af_d  = af_a + (af_b - af_a) * af_gold
+        af_want = 'd'
+        pos = af_d
+    if af_b - af_a < af_tol:
+        af_state = 0
+        pos = af_move((af_a + af_b)/2)
+        af_lock = str(pos) + " in " + str(af_moves) + " moves, " + str(round(time.monotonic() - af_time,1)) + "s"
+        return pos
+    return af_move(pos)
+
 pygame.init()
 if frame == 1:
     if sq_dis == 0 and fullscreen == 1:
@@ -550,10 +773,12 @@ def draw_Vbar(col,row,color,msg,value):
     pygame.display.update()
 
 def preview():
-    global scientif,scientific,fxx,fxy,fxz,v3_focus,v3_hdr,v3_f_mode,v3_f_modes,prev_fps,focus_fps,focus_mode,restart,rpistr,count,p, brightness,contrast,modes,mode,red,blue,gain,sspeed,ev,preview_width,preview_height,zoom,igw,igh,zx,zy,awbs,awb,saturations,saturation,meters,meter,flickers,flicker,sharpnesss,sharpness
+    global scientif,scientific,fxx,fxy,fxz,v3_focus,v3_hdr,v3_f_mode,v3_f_modes,prev_fps,focus_fps,focus_mode,restart,rpistr,count,p, brightness,contrast,modes,mode,red,blue,gain,sspeed,ev,preview_width,preview_height,zoom,igw,igh,zx,zy,awbs,awb,saturations,saturation,meters,meter,flickers,flicker,sharpnesss,sharpness,af_seq
     files = glob.glob('/run/shm/*.jpg')
     for f in files:
         os.remove(f)
+    # the new libcamera-vid numbers its segments from 0 again
+    af_seq = -1
     speed2 = sspeed
     speed2 = min(speed2,2000000)
     rpistr = "libcamera-vid --camera " + str(camera) + " -n --codec mjpeg -t 0 --segment 1"
@@ -867,6 +1092,7 @@ old_histarea = histarea
 
 # start preview
 text(0,0,6,2,1,"Please Wait for preview...",int(fv*1.7),1)
+af_begin()
 preview()
 
 # main loop
@@ -880,7 +1106,7 @@ while True:
         v3_focus += 1
         v3_focus = min(v3_focus,v3_pmax)
         draw_Vbar(1,7,dgryColor,'focus',v3_focus * 4)
-        os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(v3_focus))
+        focus_set(v3_focus)
         text(1,7,3,0,1,'<<< ' + str(v3_focus) + ' >>>',fv,0)
         time.sleep(0.25)
         
@@ -892,6 +1118,7 @@ while True:
                     pmax = video_limits[f+2]
             focus_mode = 1
             foc_man = 1 # manual focus
+            af_state = 0
             zoom = 0
             button(1,7,1,9)
         if buttonFDN.is_pressed:
@@ -900,7 +1127,7 @@ while True:
             focus += 10
         focus = max(pmin,focus)
         focus = min(pmax,focus)
-        os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+        focus_set(focus)
         text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
         draw_Vbar(1,7,dgryColor,'focus',focus)
         text(1,7,3,1,1,"manual",fv,0)
@@ -914,15 +1141,25 @@ while True:
         v3_focus -= 1
         v3_focus = max(v3_focus,v3_pmin)
         draw_Vbar(1,7,dgryColor,'focus',v3_focus * 4)
-        os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(v3_focus))
+        focus_set(v3_focus)
         text(1,7,3,0,1,'<<< ' + str(v3_focus) + ' >>>',fv,0)
         time.sleep(0.25)
         
-    pics = glob.glob('/run/shm/*.jpg')
+    # show the newest complete segment, while AF is running the first one taken after the lens last moved
+    pics = shm_frames()
+    new_frame = 0
     if len(pics) > 1:
+        pic = len(pics) - 2
+        if af_state > 0:
+            for tt in range(0,len(pics) - 1):
+                if shm_seq(pics[tt]) > af_seq:
+                    pic = tt
+                    break
         try:
-            image = pygame.image.load(pics[1])
-            for tt in range(1,len(pics)):
+            image = pygame.image.load(pics[pic])
+            new_frame = 1
+            frame_seq = shm_seq(pics[pic])
+            for tt in range(0,pic + 1):
                  os.remove(pics[tt])
         except pygame.error:
             pass
@@ -1052,7 +1289,7 @@ while True:
                 windowSurfaceObj.blit(graph, (10,preview_height-110))
             if rotate != 0:
                 pygame.draw.rect(windowSurfaceObj,blackColor,Rect(0,0,int(preview_width/4.5),int(preview_height/8)),0)
-            foc = cv2.Laplacian(gray, cv2.CV_64F).var()
+            foc = focus_value(gray,focus_metric)
             text(20,0,3,2,0,"Focus: " + str(int(foc)),fv* 2,0)
             pygame.draw.rect(windowSurfaceObj,redColor,Rect(xx-histarea,xy-histarea,histarea*2,histarea*2),1)
             pygame.draw.line(windowSurfaceObj,(255,255,255),(xx-int(histarea/2),xy),(xx+int(histarea/2),xy),1)
@@ -1126,44 +1363,22 @@ while True:
                     pygame.draw.rect(windowSurfaceObj,(155,0,150),Rect(int(preview_height * 0.51),int(preview_width * 0.15),int(preview_height * 0.33),int(preview_width * 0.45)),gw)
                 elif Pi_Cam == 2 and ((vwidth == 640 and vheight == 480) or (vwidth == 720 and vheight == 540)):
                     pygame.draw.rect(windowSurfaceObj,(155,0,150),Rect(int(preview_height * 0.50),int(preview_width * 0.22),int(preview_height * 0.33),int(preview_width * 0.31)),gw)
-        # ARDUCAM AF
-        if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0 and fcount < max_fcount:
+        # ARDUCAM AF, only on a newly loaded frame, a half written jpg leaves the last one in image
+        if (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0 and af_state > 0 and new_frame == 1 and frame_seq > af_seq:
                 image2 = pygame.surfarray.pixels3d(image)
                 crop2 = image2[xx-histarea:xx+histarea,xy-histarea:xy+histarea]
                 gray = cv2.cvtColor(crop2,cv2.COLOR_RGB2GRAY)
-                foc = cv2.Laplacian(gray, cv2.CV_64F).var()
-                for f in range(0,len(video_limits)-1,3):
-                    if video_limits[f] == 'focus':
-                        pmin = video_limits[f+1]
-                        pmax = video_limits[f+2]
-                if foc >= 50:
-                    ran = 0
-                else:
-                    focus = random.randint(100, 4000)
-                    fcount = 1
-                    ran = 1
-                    old_foc = foc
-                if (int(foc) >= int(old_foc) or fcount == 0) and ran == 0:
-                    if fcount == 0:
-                        if focus < 2000:
-                            focus  += fstep
-                        else:
-                            focus  -= fstep
-                    else:        
-                        focus  += fstep
-                elif ran == 0:
-                    fstep = -fstep
-                    focus += fstep
-                old_foc = foc
-                focus = max(pmin,focus)
-                focus = min(pmax,focus)
+                foc = focus_value(gray,af_metric)
+                pos = af_frame(foc)
+                if pos != None:
+                    focus = pos
+                    focus_set(focus)
+                    pics = shm_frames()
+                    if len(pics) > 0:
+                        af_seq = shm_seq(pics[-1]) + af_settle
                 text(20,1,3,2,0,"Ctrl : " + str(int(focus)),fv* 2,0)
-                if focus < 100 or focus > 4000:
-                    focus = 2000
-                    fcount = 0
-                os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
-                time.sleep(.5)
-                fcount += 1
+        elif (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0 and af_lock != "":
+                text(20,1,3,2,0,"AF : " + af_lock,fv* 2,0)
         pygame.display.update()
 
     
@@ -2059,7 +2274,7 @@ while True:
                 if (mousex > preview_width + bw and mousey < ((button_row-1)*bh) + (bh/3)) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     focus = int(((mousex-preview_width-bw) / bw) * pmax)
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                 elif mousex > preview_width + bw and mousey > ((button_row-1)*bh) + (bh/3) and mousey < ((button_row-1)*bh) + (bh/1.5) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     if button_pos == 2:
@@ -2067,13 +2282,13 @@ while True:
                     elif button_pos == 3:
                         focus += 10
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
 
                 elif (mousey > preview_height + (bh*3) and mousey < preview_height + (bh*3) + (bh/3)) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     focus = int(((mousex-((button_row - 8)*bw)) / bw)* pmax)
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                 elif mousey > preview_height + (bh*3) and mousey > preview_height + (bh*3) + (bh/3) and mousey < preview_height + (bh*3) + (bh/1.5) and (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                     if button_pos == 0:
@@ -2081,7 +2296,7 @@ while True:
                     elif button_pos == 1:
                         focus += 10
                     draw_Vbar(1,7,dgryColor,'focus',focus)
-                    os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                    focus_set(focus)
                     text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                 # new v3
                 elif (mousex > preview_width + bw and mousey < ((button_row-1)*bh) + (bh/3)) and Pi_Cam == 3 and foc_man == 1:
@@ -2155,22 +2370,15 @@ while True:
                     elif (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 0:
                         focus_mode = 1
                         foc_man = 1 # manual focus
+                        af_state = 0
                         #zoom = 0
                         button(1,7,1,9)
-                        if os.path.exists("ctrls.txt"):
-                            os.remove("ctrls.txt")
-                        os.system("v4l2-ctl -d /dev/v4l-subdev1 --list-ctrls >> ctrls.txt")
                         restart = 1
                         time.sleep(0.25)
-                        ctrlstxt = []
-                        with open("ctrls.txt", "r") as file:
-                            line = file.readline()
-                            while line:
-                                ctrlstxt.append(line.strip())
-                                line = file.readline()
-                        foc_ctrl = ctrlstxt[3].split('value=')
-                        focus = int(foc_ctrl[1])
-                        os.system("v4l2-ctl -d /dev/v4l-subdev1 -c focus_absolute=" + str(focus))
+                        foc_ctrl = focus_get()
+                        if foc_ctrl != None:
+                            focus = foc_ctrl
+                        focus_set(focus)
                         text(1,7,3,0,1,'<<< ' + str(focus) + ' >>>',fv,0)
                         draw_Vbar(1,7,dgryColor,'focus',focus)
                         text(1,7,3,1,1,"manual",fv,0)
@@ -2178,7 +2386,7 @@ while True:
                     elif (Pi_Cam == 5 or Pi_Cam == 6) and foc_man == 1:
                         focus_mode = 0
                         foc_man = 0
-                        fcount = 0
+                        af_begin()
                         zoom = 0
                         button(1,7,0,9)
                         text(1,7,5,0,1,"FOCUS",ft,7)
@@ -2267,7 +2475,7 @@ while True:
                     fxy = 0
                     fxz = 1
                     fyz = 1
-                    fcount = 0
+                    af_begin()
                     if Pi_Cam == 3 and v3_f_mode == 0:
                         text(1,7,3,1,1,str(v3_f_modes[v3_f_mode]),fv,7)
                 restart = 1
@@ -2492,7 +2700,7 @@ while True:
         elif (event.type == MOUSEBUTTONUP):
             mousex, mousey = event.pos
             if mousex < preview_width and mousey < preview_height and rotate == 0 and event.button != 3:
-                fcount = 0
+                af_begin()
                 xx = mousex
                 xx = min(xx,preview_width - histarea)
                 xx = max(xx,histarea)
@@ -2528,6 +2736,7 @@ while True:
                 poll = p.poll()
                 if poll == None:
                     os.killpg(p.pid, signal.SIGTERM)
+                focus_close()
                 Camera_Version()
                 restart = 1
             if (sq_dis == 0 and mousex > preview_width) or (sq_dis == 1 and mousey > preview_height):